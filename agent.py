@@ -1,9 +1,30 @@
 import os
+import sys
+import json
+import re
+import sqlite3
+import hashlib
 import time
+import random
+import signal
+import asyncio
 import threading
-import schedule
+import hmac
+import queue
+import heapq
+import contextvars
+import functools
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import requests
+import aiohttp
+import aiohttp.web
+from bisect import bisect_right
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
 from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
 import telebot
 import anthropic
 
@@ -14,21 +35,99 @@ TELEGRAM_TOKEN = os.environ.get("TELEGRAM_TOKEN", "")
 MY_CHAT_ID = int(os.environ.get("MY_CHAT_ID", "0"))
 ANTHROPIC_KEY = os.environ.get("ANTHROPIC_KEY", "")
 
-ISRAEL_UTC_OFFSET = 2
+ISRAEL_TZ = ZoneInfo("Asia/Jerusalem")
+CLAUDE_MODEL = "claude-sonnet-4-20250514"
+# Faster model for the last attempts, once a call has used up most of its budget; empty = off
+CLAUDE_FALLBACK_MODEL = os.environ.get("CLAUDE_FALLBACK_MODEL", "")
+# Seconds a Claude call may take with all its retries: interactive replies vs scheduled slots
+CLAUDE_BUDGETS = {"chat": float(os.environ.get("CLAUDE_CHAT_BUDGET", "90")),
+                  "slot": float(os.environ.get("CLAUDE_SLOT_BUDGET", "600"))}
+CLAUDE_FALLBACK_SHARE = 0.35
+CLAUDE_BACKOFF_BASE = 1.0
+CLAUDE_BACKOFF_CAP = 30.0
+# After this many failed attempts in a row, Claude calls fail fast for CLAUDE_BREAKER_COOLDOWN seconds
+CLAUDE_BREAKER_FAILURES = int(os.environ.get("CLAUDE_BREAKER_FAILURES", "5"))
+CLAUDE_BREAKER_COOLDOWN = float(os.environ.get("CLAUDE_BREAKER_COOLDOWN", "60"))
+
+WIKI_FEED_URL = os.environ.get("WIKI_FEED_URL", "https://en.wikipedia.org/api/rest_v1/feed/onthisday")
+# Background refresh revalidates corpus dates older than this; lookups never do
+CORPUS_MAX_AGE_DAYS = int(os.environ.get("CORPUS_MAX_AGE_DAYS", "30"))
+CORPUS_REFRESH_PER_HOUR = 2
+FACTS_DB = os.environ.get("FACTS_DB", "motivator.db")
+# A used fact becomes eligible again after this many days; 0 = never (also dedupes across years)
+FACT_REUSE_DAYS = int(os.environ.get("FACT_REUSE_DAYS", "0"))
+# Facts offered to Claude per call, after ranking
+EVENT_TOP_K = int(os.environ.get("EVENT_TOP_K", "10"))
+BIRTH_TOP_K = int(os.environ.get("BIRTH_TOP_K", "6"))
+# Facts resembling ones told in the last NOVELTY_DAYS rank lower, by up to NOVELTY_PENALTY points
+NOVELTY_DAYS = int(os.environ.get("NOVELTY_DAYS", "30"))
+NOVELTY_PENALTY = float(os.environ.get("NOVELTY_PENALTY", "3"))
+# How long before each slot its message is generated
+PREGEN_LEAD_MINUTES = int(os.environ.get("PREGEN_LEAD_MINUTES", "20"))
+# Slots missed while the bot was down are still sent if it's back within this window
+CATCHUP_GRACE_MINUTES = int(os.environ.get("CATCHUP_GRACE_MINUTES", "90"))
+# Interactive replies are streamed into the chat by editing a placeholder message
+STREAM_REPLIES = os.environ.get("STREAM_REPLIES", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.environ.get("STREAM_EDIT_INTERVAL", "1.0"))
+# "threads" (TeleBot + scheduler thread) or "async" (one event loop, AsyncTeleBot + AsyncAnthropic)
+RUNTIME = os.environ.get("RUNTIME", "threads")
+CLAUDE_CONCURRENCY = int(os.environ.get("CLAUDE_CONCURRENCY", "4"))
+CHAT_QUEUE_SIZE = int(os.environ.get("CHAT_QUEUE_SIZE", "20"))
+CHAT_IDLE_SECONDS = 60
+# Other chats join with /join <INVITE_CODE>; empty = owner only
+INVITE_CODE = os.environ.get("INVITE_CODE", "")
+DEFAULT_TZ = os.environ.get("DEFAULT_TZ", "Asia/Jerusalem")
+PERSONALIZE_CONCURRENCY = int(os.environ.get("PERSONALIZE_CONCURRENCY", "8"))
+PERSONAL_MAX_TOKENS = 800
+# "polling" or "webhook": Telegram posts updates to an embedded HTTP server at WEBHOOK_URL.
+# Replicas share state (subscribers, claimed updates, leased outbox rows) through the
+# SQLite file at FACTS_DB, so they must run on one host with that file on local disk. On
+# Heroku-style platforms, where every dyno has its own disk, run exactly one process:
+# the Procfile's worker for polling, or change its type to web with UPDATES=webhook
+# (the platform routes $PORT only to web) — never both, polling removes the webhook.
+UPDATES = os.environ.get("UPDATES", "polling")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+WEBHOOK_PATH = "/telegram"
+PORT = int(os.environ.get("PORT", "8080"))
+WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS", "4"))
+# Only one replica on the host should run the scheduler
+RUN_SCHEDULER = os.environ.get("RUN_SCHEDULER", "1") == "1"
+# Outgoing messages: Telegram allows about 30 messages/s per bot, 1/s per chat and 20/min per group
+SEND_RATE = float(os.environ.get("SEND_RATE", "25"))
+SEND_CHAT_RATE = 1.0
+SEND_CHAT_BURST = 3
+SEND_GROUP_RATE = 20 / 60
+SEND_WORKERS = int(os.environ.get("SEND_WORKERS", "8"))
+SEND_MAX_ATTEMPTS = 5
+# Replicas sharing FACTS_DB each send only the outbox rows they hold a lease on;
+# rows whose lease ran out (their replica died) are taken over by another one
+OUTBOX_LEASE = float(os.environ.get("OUTBOX_LEASE", "60"))
+OUTBOX_OWNER = f"{os.getpid()}-{random.getrandbits(32):08x}"
+# Prometheus-style /metrics and the sampling profiler on 127.0.0.1:METRICS_PORT; 0 = off
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+# One JSON line per handled update and scheduled job
+TRACE_LOG = os.environ.get("TRACE_LOG", "1") == "1"
 
 bot = telebot.TeleBot(TELEGRAM_TOKEN)
-claude = anthropic.Anthropic(api_key=ANTHROPIC_KEY)
-# Track used facts per day to avoid repetition
-used_facts_today = {"date": "", "morning": "", "afternoon": "", "evening": ""}
+# Retries are ours (call_claude), so they stay within the caller's budget
+claude = anthropic.Anthropic(api_key=ANTHROPIC_KEY, max_retries=0)
+# Local state: facts corpus, used facts, subscribers, seen updates
+db = sqlite3.connect(FACTS_DB, check_same_thread=False)
+db_lock = threading.Lock()
+with db_lock:
+    db.execute("PRAGMA journal_mode=WAL")
 
 # ============================================================
 # HELPERS
 # ============================================================
 def get_israel_now():
-    from datetime import timezone
-    return datetime.now(timezone.utc) + timedelta(hours=ISRAEL_UTC_OFFSET)
+    return datetime.now(ISRAEL_TZ)
+
+def local_now(tz):
+    return datetime.now(ZoneInfo(tz))
 
-def today_display():
+def today_display(now=None):
     months_ru = {
         1: "января", 2: "февраля", 3: "марта", 4: "апреля",
         5: "мая", 6: "июня", 7: "июля", 8: "августа",
@@ -38,115 +137,1033 @@ def today_display():
         0: "Понедельник", 1: "Вторник", 2: "Среда", 3: "Четверг",
         4: "Пятница", 5: "Суббота", 6: "Воскресенье"
     }
-    now = get_israel_now()
+    now = now or get_israel_now()
     return f"{days_ru[now.weekday()]}, {now.day} {months_ru[now.month]} {now.year}"
 
 # ============================================================
-# WEB SEARCH FOR HISTORICAL FACTS
+# METRICS & TRACING
 # ============================================================
-def fetch_this_day_facts():
-    """Fetch real historical facts for today from Wikipedia API."""
-    now = get_israel_now()
-    day, month = now.day, now.month
-    facts = ""
+# Every handled update and scheduled job runs inside a trace; stages on the
+# hot path (facts, claude, telegram) add their wall time to the current
+# trace and to process-wide histograms served at /metrics.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+METRIC_HELP = {
+    "motivator_stage_seconds": ("histogram", "Wall time of one hot-path stage"),
+    "motivator_trace_seconds": ("histogram", "Wall time of a handled update or scheduled job"),
+    "motivator_claude_calls_total": ("counter", "Claude calls by prompt cache outcome"),
+    "motivator_claude_retries_total": ("counter", "Claude calls retried after an overload"),
+    "motivator_claude_errors_total": ("counter", "Claude calls that gave up"),
+    "motivator_tokens_total": ("counter", "Claude tokens by kind"),
+    "motivator_facts_lookups_total": ("counter", "Facts cache lookups by where the day was found"),
+    "motivator_telegram_messages_total": ("counter", "Messages sent to Telegram"),
+    "motivator_telegram_errors_total": ("counter", "Failed Telegram sends"),
+    "motivator_outbox_delay_seconds": ("histogram", "Time from queueing a message part to Telegram accepting it"),
+}
+metrics_lock = threading.Lock()
+counters = {}
+histograms = {}
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+def inc(name, value=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with metrics_lock:
+        counters[key] = counters.get(key, 0) + value
+
+def observe(name, seconds, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with metrics_lock:
+        buckets = histograms.setdefault(key, [0] * len(LATENCY_BUCKETS) + [0.0, 0])
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                buckets[i] += 1
+        buckets[-2] += seconds
+        buckets[-1] += 1
+
+def label_text(labels):
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}" if labels else ""
+
+def render_metrics():
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    described = set()
+
+    def describe(name):
+        if name not in described:
+            described.add(name)
+            kind, text = METRIC_HELP.get(name, ("untyped", name))
+            lines.extend((f"# HELP {name} {text}", f"# TYPE {name} {kind}"))
+
+    with metrics_lock:
+        for (name, labels), value in sorted(counters.items()):
+            describe(name)
+            lines.append(f"{name}{label_text(labels)} {value}")
+        for (name, labels), buckets in sorted(histograms.items()):
+            describe(name)
+            for bound, count in zip(LATENCY_BUCKETS, buckets):
+                lines.append(f"{name}_bucket{label_text(labels + (('le', bound),))} {count}")
+            lines.append(f"{name}_bucket{label_text(labels + (('le', '+Inf'),))} {buckets[-1]}")
+            lines.append(f"{name}_sum{label_text(labels)} {buckets[-2]:.6f}")
+            lines.append(f"{name}_count{label_text(labels)} {buckets[-1]}")
+    with cache_stats_lock:
+        calls, hits = cache_stats["calls"], cache_stats["hits"]
+    lines += ["# HELP motivator_prompt_cache_hit_ratio Share of Claude calls that read the prompt cache",
+              "# TYPE motivator_prompt_cache_hit_ratio gauge",
+              f"motivator_prompt_cache_hit_ratio {hits / calls if calls else 0:.4f}",
+              "# HELP motivator_outbox_pending Message parts waiting to be delivered",
+              "# TYPE motivator_outbox_pending gauge",
+              f"motivator_outbox_pending {outbox.size()}"]
+    return "\n".join(lines) + "\n"
+
+class Trace:
+    """What one update or job spent, stage by stage. Stages may be added from several threads."""
+
+    def __init__(self, kind, chat_id=None, **fields):
+        self.kind = kind
+        self.chat_id = chat_id
+        self.fields = fields
+        self.started = time.time()
+        self.stages = {}
+        self.counts = {}
+        self.lock = threading.Lock()
 
-    # Wikipedia On This Day — events
+    def add_stage(self, name, seconds):
+        with self.lock:
+            self.stages[name] = self.stages.get(name, 0) + seconds
+
+    def add(self, field, value=1):
+        with self.lock:
+            self.counts[field] = self.counts.get(field, 0) + value
+
+    def log_line(self, seconds, ok):
+        with self.lock:
+            return json.dumps({
+                "ts": round(self.started, 3), "kind": self.kind, "chat_id": self.chat_id, **self.fields, "ok": ok,
+                "ms": round(seconds * 1000),
+                "stages_ms": {name: round(s * 1000) for name, s in self.stages.items()},
+                **self.counts,
+            }, ensure_ascii=False)
+
+def trace_add(field, value=1):
+    t = current_trace.get()
+    if t:
+        t.add(field, value)
+
+@contextmanager
+def trace(kind, chat_id=None, **fields):
+    """Collect the stages of one update or job and log them as a JSON line. Nested traces join the outer one."""
+    if current_trace.get():
+        yield current_trace.get()
+        return
+    t = Trace(kind, chat_id, **fields)
+    token = current_trace.set(t)
+    start = time.perf_counter()
+    ok = False
     try:
-        url = f"https://en.wikipedia.org/api/rest_v1/feed/onthisday/events/{month:02d}/{day:02d}"
-        resp = requests.get(url, headers={"User-Agent": "MotivatorBot/1.0"}, timeout=15)
-        if resp.status_code == 200:
-            events = resp.json().get("events", [])
-            keywords = ["compan", "invent", "found", "launch", "patent", "discover",
-                        "first", "record", "billion", "million", "startup", "technolog",
-                        "israel", "revolution", "independ", "nobel", "space", "comput",
-                        "internet", "phone", "electric", "medicine", "women", "rights",
-                        "freedom", "surviv", "overcame", "bankrupt", "fail", "success",
-                        "entrepren", "business", "market", "apple", "google", "amazon",
-                        "tesla", "microsoft", "war", "peace", "treaty"]
-            selected = []
-            other = []
-            for e in events:
-                text = e.get("text", "")
-                year = e.get("year", "")
-                entry = f"[{year}] {text}"
-                if any(kw in text.lower() for kw in keywords):
-                    selected.append(entry)
-                else:
-                    other.append(entry)
-            import random
-            random.shuffle(other)
-            all_events = selected[:10] + other[:5]
-            if all_events:
-                facts += "СОБЫТИЯ ЭТОГО ДНЯ В ИСТОРИИ:\n"
-                for s in all_events:
-                    facts += f"- {s}\n"
-    except Exception as e:
-        print(f"Wikipedia events error: {e}")
+        yield t
+        ok = True
+    finally:
+        current_trace.reset(token)
+        seconds = time.perf_counter() - start
+        observe("motivator_trace_seconds", seconds, kind=kind)
+        if TRACE_LOG:
+            print(t.log_line(seconds, ok), flush=True)
+
+def traced(kind):
+    """Run a handler inside a trace; the chat comes from its first argument (a message or a subscriber)."""
+    def chat_of(arg):
+        return arg["chat_id"] if isinstance(arg, dict) else arg.chat.id
 
-    # Wikipedia On This Day — births
+    def decorate(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def awrapper(arg, *args, **kwargs):
+                with trace(kind, chat_of(arg)):
+                    return await fn(arg, *args, **kwargs)
+            return awrapper
+
+        @functools.wraps(fn)
+        def wrapper(arg, *args, **kwargs):
+            with trace(kind, chat_of(arg)):
+                return fn(arg, *args, **kwargs)
+        return wrapper
+    return decorate
+
+@contextmanager
+def stage(name):
+    start = time.perf_counter()
     try:
-        url = f"https://en.wikipedia.org/api/rest_v1/feed/onthisday/births/{month:02d}/{day:02d}"
-        resp = requests.get(url, headers={"User-Agent": "MotivatorBot/1.0"}, timeout=15)
-        if resp.status_code == 200:
-            births = resp.json().get("births", [])
-            biz_keywords = ["entrepren", "business", "invent", "found", "ceo",
-                            "billion", "scientist", "pioneer", "leader", "nobel",
-                            "author", "philosoph", "israel", "engineer", "vision"]
-            notable = []
-            for b in births:
-                text = b.get("text", "")
-                year = b.get("year", "")
-                if any(kw in text.lower() for kw in biz_keywords):
-                    notable.append(f"[{year}] {text}")
-            if notable:
-                facts += "\nРОДИЛИСЬ В ЭТОТ ДЕНЬ:\n"
-                for n in notable[:8]:
-                    facts += f"- {n}\n"
-    except Exception as e:
-        print(f"Wikipedia births error: {e}")
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        observe("motivator_stage_seconds", seconds, stage=name)
+        t = current_trace.get()
+        if t:
+            t.add_stage(name, seconds)
+
+class SamplingProfiler:
+    """Samples every thread's stack at a fixed interval and counts them as folded stacks (flamegraph.pl input)."""
+
+    def __init__(self):
+        self.counts = {}
+        self.thread = None
+        self.running = threading.Event()
+
+    def start(self, interval=0.01):
+        if self.running.is_set():
+            return
+        self.counts = {}
+        self.running.set()
+        self.thread = threading.Thread(target=self.run, args=(interval,), daemon=True, name="profiler")
+        self.thread.start()
 
-    return facts if facts else "Факты не загрузились. Используй свои знания о событиях этого дня."
+    def stop(self):
+        self.running.clear()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        return self.folded()
+
+    def run(self, interval):
+        me = threading.get_ident()
+        names = {}
+        while self.running.is_set():
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                key = ";".join(reversed(stack))
+                self.counts[key] = self.counts.get(key, 0) + 1
+            time.sleep(interval)
+
+    def folded(self):
+        return "".join(f"{stack} {n}\n" for stack, n in sorted(self.counts.items(), key=lambda kv: -kv[1]))
+
+profiler = SamplingProfiler()
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """GET /metrics; POST /profile/start?interval=0.01, GET /profile (so far), POST /profile/stop (final)."""
+
+    def reply(self, status, text, content_type="text/plain; version=0.0.4"):
+        body = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path == "/metrics":
+            self.reply(200, render_metrics())
+        elif path == "/profile":
+            self.reply(200, profiler.folded())
+        else:
+            self.reply(404, "not found\n")
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path == "/profile/start":
+            interval = float(parse_qs(url.query).get("interval", ["0.01"])[0])
+            profiler.start(interval)
+            self.reply(200, f"profiling every {interval}s\n")
+        elif url.path == "/profile/stop":
+            self.reply(200, profiler.stop())
+        else:
+            self.reply(404, "not found\n")
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server():
+    if not METRICS_PORT:
+        return
+    try:
+        server = ThreadingHTTPServer(("127.0.0.1", METRICS_PORT), MetricsHandler)
+    except OSError as e:
+        # Another process on the host may hold the port; the bot runs without metrics
+        print(f"Metrics server not started on 127.0.0.1:{METRICS_PORT}: {e}")
+        return
+    threading.Thread(target=server.serve_forever, daemon=True, name="metrics").start()
+    print(f"📈 Metrics on 127.0.0.1:{METRICS_PORT}/metrics")
 
 # ============================================================
-# CLAUDE API
+# WEB SEARCH FOR HISTORICAL FACTS
 # ============================================================
-def call_claude(system_prompt, user_content, max_tokens=4000, retries=3):
-    for attempt in range(retries):
-        try:
-            response = claude.messages.create(
-                model="claude-sonnet-4-20250514",
-                max_tokens=max_tokens,
-                system=system_prompt,
-                messages=[{"role": "user", "content": user_content}]
-            )
-            return response.content[0].text
-        except anthropic.APIStatusError as e:
-            if e.status_code == 529 and attempt < retries - 1:
-                time.sleep((attempt + 1) * 10)
-                continue
-            print(f"Claude error: {e.status_code}")
+# Keyword stems and how much each one makes a fact worth telling
+EVENT_KEYWORDS = {
+    "entrepren": 3, "startup": 3, "business": 3, "compan": 3, "found": 3,
+    "invent": 3, "patent": 3, "bankrupt": 3, "overcame": 3, "israel": 3,
+    "launch": 2, "discover": 2, "billion": 2, "million": 2, "technolog": 2,
+    "comput": 2, "internet": 2, "market": 2, "success": 2, "fail": 2,
+    "surviv": 2, "nobel": 2, "apple": 2, "google": 2, "amazon": 2,
+    "tesla": 2, "microsoft": 2, "first": 1, "record": 1, "revolution": 1,
+    "independ": 1, "space": 1, "phone": 1, "electric": 1, "medicine": 1,
+    "women": 1, "rights": 1, "freedom": 1, "war": 1, "peace": 1, "treaty": 1,
+}
+BIRTH_KEYWORDS = {
+    "entrepren": 3, "business": 3, "invent": 3, "found": 3, "ceo": 3,
+    "billion": 2, "pioneer": 2, "engineer": 2, "israel": 2, "vision": 2,
+    "scientist": 1, "leader": 1, "nobel": 1, "author": 1, "philosoph": 1,
+}
+
+# The full-year On This Day corpus lives in SQLite (built once with
+# `python agent.py build-corpus`); facts_cache keeps the few dates in use
+# in memory: (month, day) -> {"events": [...], "births": [...], "fetched_at": ts}.
+# Each fact's keyword relevance and hash are computed once when its date is
+# stored, and a date's facts are kept best first.
+with db_lock:
+    db.execute("""CREATE TABLE IF NOT EXISTS corpus (
+        month INTEGER NOT NULL,
+        day INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        year TEXT NOT NULL,
+        text TEXT NOT NULL,
+        relevance REAL,
+        hash TEXT)""")
+    if "hash" not in {row[1] for row in db.execute("PRAGMA table_info(corpus)")}:
+        # Corpora built before these columns get them filled in as their dates are loaded
+        db.execute("ALTER TABLE corpus ADD COLUMN relevance REAL")
+        db.execute("ALTER TABLE corpus ADD COLUMN hash TEXT")
+    db.execute("CREATE INDEX IF NOT EXISTS corpus_date ON corpus (month, day)")
+    db.execute("""CREATE TABLE IF NOT EXISTS corpus_days (
+        month INTEGER NOT NULL,
+        day INTEGER NOT NULL,
+        fetched_at REAL NOT NULL,
+        PRIMARY KEY (month, day))""")
+    db.commit()
+
+# Least recently used first
+facts_cache = OrderedDict()
+facts_cache_lock = threading.Lock()
+facts_refreshing = set()
+FACTS_CACHE_DAYS = 8
+wiki_session = requests.Session()
+wiki_session.headers.update({"User-Agent": "MotivatorBot/1.0"})
+wiki_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="wiki")
+
+def load_day(month, day):
+    """A date's feed from the local corpus, or None if it was never fetched."""
+    with db_lock:
+        row = db.execute("SELECT fetched_at FROM corpus_days WHERE month = ? AND day = ?", (month, day)).fetchone()
+        if row is None:
             return None
+        rows = db.execute("SELECT kind, year, text, relevance, hash FROM corpus WHERE month = ? AND day = ? "
+                          "ORDER BY relevance DESC, hash", (month, day)).fetchall()
+    entry = {"fetched_at": row[0], "events": [], "births": []}
+    for kind, year, text, relevance, hash_ in rows:
+        entry[kind].append({"year": year, "text": text, "relevance": relevance, "hash": hash_})
+    if any(r[4] is None for r in rows):
+        save_day(month, day, score_day(entry))
+    return entry
+
+def save_day(month, day, entry):
+    with db_lock:
+        db.execute("DELETE FROM corpus WHERE month = ? AND day = ?", (month, day))
+        db.executemany("INSERT INTO corpus (month, day, kind, year, text, relevance, hash) "
+                       "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                       [(month, day, kind, str(item["year"]), item["text"], item["relevance"], item["hash"])
+                        for kind in ("events", "births") for item in entry[kind]])
+        db.execute("INSERT OR REPLACE INTO corpus_days (month, day, fetched_at) VALUES (?, ?, ?)",
+                   (month, day, entry["fetched_at"]))
+        db.commit()
+
+def remember_day(month, day, entry):
+    with facts_cache_lock:
+        facts_cache[(month, day)] = entry
+        facts_cache.move_to_end((month, day))
+        while len(facts_cache) > FACTS_CACHE_DAYS:
+            facts_cache.popitem(last=False)
+
+def cached_day(month, day):
+    """Memory first, then the local corpus; None means it has to be fetched."""
+    with facts_cache_lock:
+        entry = facts_cache.get((month, day))
+        if entry is not None:
+            facts_cache.move_to_end((month, day))
+    if entry is not None:
+        inc("motivator_facts_lookups_total", source="memory")
+        return entry
+    entry = load_day(month, day)
+    if entry is not None:
+        remember_day(month, day, entry)
+    inc("motivator_facts_lookups_total", source="corpus" if entry else "miss")
+    return entry
+
+def parse_feed(kind, data):
+    return [{"year": str(item.get("year", "")), "text": item.get("text", "")}
+            for item in data.get(kind, [])]
+
+def fetch_onthisday(kind, month, day):
+    """Fetch one Wikipedia On This Day feed ("events" or "births"), keeping only year and text."""
+    resp = wiki_session.get(f"{WIKI_FEED_URL}/{kind}/{month:02d}/{day:02d}", timeout=15)
+    resp.raise_for_status()
+    return parse_feed(kind, resp.json())
+
+def refresh_day(month, day):
+    """Fetch events and births for a date concurrently and store them in the corpus.
+
+    Returns the new entry, or None if both feeds failed.
+    """
+    futures = {kind: wiki_pool.submit(fetch_onthisday, kind, month, day) for kind in ("events", "births")}
+    feeds = {}
+    for kind, future in futures.items():
+        try:
+            feeds[kind] = future.result()
         except Exception as e:
-            print(f"Claude exception: {e}")
+            print(f"Wikipedia {kind} error: {e}")
+            feeds[kind] = None
+    return store_day(month, day, feeds)
+
+def store_day(month, day, feeds):
+    """Store freshly fetched feeds ({kind: list, or None if that fetch failed})."""
+    entry = {"fetched_at": time.time(), **feeds}
+    previous = cached_day(month, day) or {}
+    # A failed feed keeps whatever we had before instead of wiping it
+    for kind in ("events", "births"):
+        if entry[kind] is None:
+            entry[kind] = previous.get(kind, [])
+    if not entry["events"] and not entry["births"]:
+        return None
+    save_day(month, day, score_day(entry))
+    remember_day(month, day, entry)
+    return entry
+
+def stale_days(limit):
+    cutoff = time.time() - CORPUS_MAX_AGE_DAYS * 86400
+    with db_lock:
+        return db.execute("SELECT month, day FROM corpus_days WHERE fetched_at < ? ORDER BY fetched_at LIMIT ?",
+                          (cutoff, limit)).fetchall()
+
+def refresh_stale_days(limit=CORPUS_REFRESH_PER_HOUR):
+    """Incremental refresh: revalidate only the oldest corpus dates."""
+    for month, day in stale_days(limit):
+        refresh_day(month, day)
+
+def all_dates():
+    d = datetime(2024, 1, 1)  # leap year, so Feb 29 is included
+    while d.year == 2024:
+        yield d.month, d.day
+        d += timedelta(days=1)
+
+def build_corpus(source_dir=None, force=False):
+    """Fill the corpus for all 366 dates, from Wikipedia or from a directory of saved feeds.
+
+    source_dir holds {kind}/MM-DD.json files in the Wikipedia feed format,
+    e.g. a fixture corpus for offline runs. Dates already present are
+    skipped unless force is set.
+    """
+    with db_lock:
+        present = set(db.execute("SELECT month, day FROM corpus_days").fetchall())
+    done, failed = 0, 0
+    for month, day in all_dates():
+        if (month, day) in present and not force:
+            continue
+        if source_dir:
+            feeds = {}
+            for kind in ("events", "births"):
+                path = os.path.join(source_dir, kind, f"{month:02d}-{day:02d}.json")
+                try:
+                    with open(path, encoding="utf-8") as f:
+                        feeds[kind] = parse_feed(kind, json.load(f))
+                except FileNotFoundError:
+                    feeds[kind] = None
+            entry = store_day(month, day, feeds)
+        else:
+            entry = refresh_day(month, day)
+        if entry:
+            done += 1
+        else:
+            failed += 1
+            print(f"{month:02d}-{day:02d}: failed")
+    print(f"Corpus: {done} dates updated, {failed} failed")
+
+def refresh_day_background(month, day):
+    with facts_cache_lock:
+        if (month, day) in facts_refreshing:
+            return
+        facts_refreshing.add((month, day))
+
+    def run():
+        try:
+            refresh_day(month, day)
+        finally:
+            with facts_cache_lock:
+                facts_refreshing.discard((month, day))
+
+    threading.Thread(target=run, daemon=True).start()
+
+def get_day_feed(month, day):
+    """Return the feed for a date from memory or the corpus, fetching it only if it was never stored.
+
+    Stored dates are served as they are; refresh_stale_days revalidates them
+    once they pass CORPUS_MAX_AGE_DAYS.
+    """
+    entry = cached_day(month, day)
+    if entry is None:
+        return refresh_day(month, day)
+    return entry
+
+class KeywordScorer:
+    """Weighted keyword stems compiled into one pattern.
+
+    A batch of texts is joined and scanned once; each match is mapped back
+    to its text by offset, and each stem counts once per text.
+    """
+
+    def __init__(self, weights):
+        self.weights = weights
+        stems = sorted(weights, key=len, reverse=True)
+        self.pattern = re.compile(r"\b(?:" + "|".join(re.escape(s) for s in stems) + ")")
+
+    def score(self, texts):
+        lowered = [t.lower() for t in texts]
+        starts = []
+        offset = 0
+        for t in lowered:
+            starts.append(offset)
+            offset += len(t) + 1
+        scores = [0] * len(lowered)
+        seen = set()
+        for m in self.pattern.finditer("\n".join(lowered)):
+            i = bisect_right(starts, m.start()) - 1
+            if (i, m.group()) not in seen:
+                seen.add((i, m.group()))
+                scores[i] += self.weights[m.group()]
+        return scores
+
+EVENT_SCORER = KeywordScorer(EVENT_KEYWORDS)
+BIRTH_SCORER = KeywordScorer(BIRTH_KEYWORDS)
+
+TOKEN = re.compile(r"[a-z]{4,}")
+STOPWORDS = {"with", "from", "that", "this", "were", "which", "their", "after",
+             "into", "during", "first", "becomes", "became", "also", "when"}
+
+def fact_tokens(text):
+    return set(TOKEN.findall(text.lower())) - STOPWORDS
+
+def novelty_overlap(text, recent_tokens):
+    """Share of a fact's words that already appeared in recently told facts (0..1)."""
+    if not recent_tokens:
+        return 0
+    tokens = fact_tokens(text)
+    if not tokens:
+        return 0
+    return len(tokens & recent_tokens) / len(tokens)
+
+def score_day(entry):
+    """Set each fact's relevance and hash and sort a date's facts best first, ties by hash."""
+    for kind, scorer in (("events", EVENT_SCORER), ("births", BIRTH_SCORER)):
+        items = entry[kind]
+        for item, relevance in zip(items, scorer.score([i["text"] for i in items])):
+            item["relevance"] = relevance
+            item["hash"] = fact_hash(item["year"], item["text"])
+        items.sort(key=lambda i: (-i["relevance"], i["hash"]))
+    return entry
+
+def rank_facts(items, k, recent_tokens, relevant_only=False):
+    """Top-k of a date's facts (sorted by score_day) by relevance minus the novelty penalty.
+
+    The penalty is at most NOVELTY_PENALTY, so nothing less relevant than the
+    k-th fact by more than that can make the top k and the scan stops there.
+    Ties break on the fact hash, so the order is stable across runs and the
+    facts block stays byte-identical for the prompt cache.
+    """
+    ranked = []
+    for i, item in enumerate(items):
+        relevance = item["relevance"]
+        if relevant_only and not relevance:
+            break
+        if i >= k and relevance < items[k - 1]["relevance"] - NOVELTY_PENALTY:
+            break
+        score = relevance - NOVELTY_PENALTY * novelty_overlap(item["text"], recent_tokens)
+        ranked.append((-score, item["hash"], item))
+    ranked.sort(key=lambda r: r[:2])
+    return [item for _, _, item in ranked[:k]]
+
+def format_facts(entry):
+    events = entry.get("events", [])
+    births = entry.get("births", [])
+    used = used_fact_hashes([i["hash"] for i in events + births])
+    events = [e for e in events if e["hash"] not in used]
+    births = [b for b in births if b["hash"] not in used]
+    recent = recent_fact_tokens()
+
+    facts = ""
+    top_events = rank_facts(events, EVENT_TOP_K, recent)
+    if top_events:
+        facts += "СОБЫТИЯ ЭТОГО ДНЯ В ИСТОРИИ:\n"
+        for e in top_events:
+            facts += f"- [{e['year']}] {e['text']}\n"
+
+    top_births = rank_facts(births, BIRTH_TOP_K, recent, relevant_only=True)
+    if top_births:
+        facts += "\nРОДИЛИСЬ В ЭТОТ ДЕНЬ:\n"
+        for b in top_births:
+            facts += f"- [{b['year']}] {b['text']}\n"
+    return facts
+
+def warm_facts_cache():
+    """Prefetch the dates subscribers are in now and tomorrow, so the first message of a day never waits on Wikipedia."""
+    now = get_israel_now()
+    for d in (now - timedelta(days=1), now, now + timedelta(days=1)):
+        if cached_day(d.month, d.day) is None:
+            refresh_day_background(d.month, d.day)
+
+def facts_text(entry):
+    if not entry:
+        return "Факты не загрузились. Используй свои знания о событиях этого дня."
+    facts = format_facts(entry)
+    return facts if facts else "Все факты этого дня уже использованы. Используй свои знания о событиях этого дня."
+
+# A date's facts block is ranked once and reused all day, so it stays a prompt
+# cache hit; facts told since then are listed in the user message (used_note).
+facts_blocks = {}
+
+def day_facts_block(now, entry):
+    date = today_key(now)
+    with facts_cache_lock:
+        block = facts_blocks.get(date)
+    if block is None:
+        block = f"Сегодня: {today_display(now)}.\n\nФАКТЫ ЭТОГО ДНЯ:\n{facts_text(entry)}"
+        if entry:
+            with facts_cache_lock:
+                block = facts_blocks.setdefault(date, block)
+                for key in sorted(facts_blocks)[:-3]:
+                    del facts_blocks[key]
+    return block
+
+def fetch_this_day_facts(now=None):
+    """Real historical facts for the day of `now` (Israel today by default), served from the date-keyed cache."""
+    now = now or get_israel_now()
+    with stage("facts"):
+        return day_facts_block(now, get_day_feed(now.month, now.day))
+
+# ============================================================
+# USED FACTS INDEX
+# ============================================================
+# Every fact that made it into a message is recorded in SQLite, keyed by a
+# hash of its year and normalized text, so it's never offered again, not
+# later today and not on the same date next year.
+with db_lock:
+    db.execute("""CREATE TABLE IF NOT EXISTS used_facts (
+        fact_hash TEXT NOT NULL,
+        year TEXT NOT NULL,
+        text TEXT NOT NULL,
+        slot TEXT NOT NULL,
+        used_on TEXT NOT NULL,
+        used_at REAL NOT NULL)""")
+    db.execute("CREATE INDEX IF NOT EXISTS used_facts_hash ON used_facts (fact_hash, used_at)")
+    db.commit()
+
+FACT_LINE = re.compile(r"^- \[(-?\d+)\] (.+)$", re.MULTILINE)
+
+def fact_hash(year, text):
+    normalized = " ".join(re.sub(r"[^\w\s]", " ", text.lower()).split())
+    return hashlib.sha1(f"{year}|{normalized}".encode("utf-8")).hexdigest()[:16]
+
+def used_fact_hashes(hashes):
+    """Those of the given fact hashes that are still within their no-reuse window."""
+    if not hashes:
+        return set()
+    since = time.time() - FACT_REUSE_DAYS * 86400 if FACT_REUSE_DAYS else 0
+    used = set()
+    with db_lock:
+        for i in range(0, len(hashes), 500):
+            batch = hashes[i:i + 500]
+            rows = db.execute(
+                f"SELECT DISTINCT fact_hash FROM used_facts WHERE used_at >= ? "
+                f"AND fact_hash IN ({','.join('?' * len(batch))})", [since, *batch])
+            used.update(row[0] for row in rows)
+    return used
+
+def recent_fact_tokens():
+    """Words from facts told within the novelty window."""
+    since = time.time() - NOVELTY_DAYS * 86400
+    with db_lock:
+        rows = db.execute("SELECT text FROM used_facts WHERE used_at >= ?", (since,)).fetchall()
+    tokens = set()
+    for (text,) in rows:
+        tokens |= fact_tokens(text)
+    return tokens
+
+YEAR = re.compile(r"(?<!\d)\d{3,4}(?!\d)")
+NUMBER = re.compile(r"(?<!\d)\d+(?!\d)")
+PROPER_NOUN = re.compile(r"\b[A-Z][A-Za-z]{3,}")
+WORD = re.compile(r"[^\W\d_]{4,}")
+TRANSLIT = [("shch", "щ"), ("sh", "ш"), ("ch", "ч"), ("zh", "ж"), ("kh", "х"), ("ts", "ц"),
+            ("ph", "ф"), ("th", "т"), ("j", "дж"), ("x", "кс"), ("w", "в"), ("q", "к"), ("c", "к"),
+            *zip("bdfghklmnprstvz", "бдфгхклмнпрствз")]
+VOWELS = set("aeiouyаеёиоуыэюяйьъ")
+
+def name_key(word):
+    """First consonants of a name in Cyrillic, so "Alaska" and "Аляску" both give "лск"."""
+    word, out = word.lower(), ""
+    while word:
+        for latin, cyrillic in TRANSLIT:
+            if word.startswith(latin):
+                out += cyrillic
+                word = word[len(latin):]
+                break
+        else:
+            out += word[0]
+            word = word[1:]
+    key = "".join(ch for ch in out if ch not in VOWELS)[:4]
+    return key if len(key) >= 3 else None
+
+def mark_facts_used(facts, response, slot):
+    """Record which of the offered facts a response told.
+
+    The model writes in Russian about English facts, so the year is the
+    link: an offered fact counts as used when its year appears in the
+    response as a standalone 3-4 digit number. When several offered facts
+    share that year, the response must also mention one of the fact's
+    names or other numbers.
+    """
+    if not response:
+        return
+    years = set(YEAR.findall(response)) - {str(get_israel_now().year)}
+    offered = [(year, text) for year, text in FACT_LINE.findall(facts) if year.lstrip("-") in years]
+    if not offered:
+        return
+    shared = {year for year, _ in offered if sum(y == year for y, _ in offered) > 1}
+    numbers = set(NUMBER.findall(response))
+    names = {name_key(word) for word in WORD.findall(response)} - {None}
+    used = [(year, text) for year, text in offered
+            if year not in shared
+            or (set(NUMBER.findall(text)) - {year.lstrip("-")}) & numbers
+            or {name_key(name) for name in PROPER_NOUN.findall(text)} & names]
+    if not used:
+        return
+    now = time.time()
+    used_on = today_key()
+    with db_lock:
+        db.executemany(
+            "INSERT INTO used_facts (fact_hash, year, text, slot, used_on, used_at) VALUES (?, ?, ?, ?, ?, ?)",
+            [(fact_hash(year, text), year, text, slot, used_on, now) for year, text in used])
+        db.commit()
+
+def used_note(facts):
+    """The facts of a (cached) facts block that have been told since it was ranked, as a note for the user message."""
+    offered = FACT_LINE.findall(facts or "")
+    used = used_fact_hashes([fact_hash(year, text) for year, text in offered])
+    told = [f"- [{year}] {text}" for year, text in offered if fact_hash(year, text) in used]
+    if not told:
+        return ""
+    return "\n\nЭТИ ФАКТЫ ИЗ СПИСКА УЖЕ РАССКАЗАНЫ — не используй их:\n" + "\n".join(told)
+
+# ============================================================
+# SUBSCRIBERS
+# ============================================================
+with db_lock:
+    db.execute("""CREATE TABLE IF NOT EXISTS subscribers (
+        chat_id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        profile TEXT NOT NULL,
+        tz TEXT NOT NULL,
+        joined_at REAL NOT NULL)""")
+    db.commit()
+
+def subscriber_row(row):
+    return {"chat_id": row[0], "name": row[1], "profile": row[2], "tz": row[3]}
+
+def ensure_owner():
+    if not MY_CHAT_ID:
+        return
+    with db_lock:
+        db.execute("INSERT OR IGNORE INTO subscribers (chat_id, name, profile, tz, joined_at) VALUES (?, ?, ?, ?, ?)",
+                   (MY_CHAT_ID, OWNER_NAME, OWNER_PROFILE, DEFAULT_TZ, time.time()))
+        db.commit()
+
+def get_subscriber(chat_id):
+    with db_lock:
+        row = db.execute("SELECT chat_id, name, profile, tz FROM subscribers WHERE chat_id = ?", (chat_id,)).fetchone()
+    return subscriber_row(row) if row else None
+
+def list_subscribers():
+    with db_lock:
+        rows = db.execute("SELECT chat_id, name, profile, tz FROM subscribers ORDER BY chat_id").fetchall()
+    return [subscriber_row(row) for row in rows]
+
+def subscribers_by_tz():
+    groups = {}
+    for sub in list_subscribers():
+        groups.setdefault(sub["tz"], []).append(sub)
+    return groups
+
+def update_subscriber(chat_id, field, value):
+    assert field in ("name", "profile", "tz")
+    with db_lock:
+        db.execute(f"UPDATE subscribers SET {field} = ? WHERE chat_id = ?", (value, chat_id))
+        db.commit()
+    if field == "tz":
+        wake_scheduler()
+
+def account_command(message):
+    """Handle /join, /profile, /tz and /stop. Returns the reply text, or None if there's nothing to say."""
+    chat_id = message.chat.id
+    command, _, arg = (message.text or "").strip().partition(" ")
+    command = command.split("@")[0]
+    arg = arg.strip()
+    sub = get_subscriber(chat_id)
+    if command == "/join":
+        if sub:
+            return "Ты уже подписан 👍"
+        if not INVITE_CODE or arg != INVITE_CODE:
             return None
+        name = message.from_user.first_name if message.from_user else ""
+        with db_lock:
+            db.execute("INSERT INTO subscribers (chat_id, name, profile, tz, joined_at) VALUES (?, ?, ?, ?, ?)",
+                       (chat_id, name or "друг", "", DEFAULT_TZ, time.time()))
+            db.commit()
+        wake_scheduler()
+        return ("🔥 Добро пожаловать!\n\n"
+                "Расскажи о себе и своём бизнесе, чтобы советы были про тебя:\n"
+                "/profile Владелица клиники эстетики в Хайфе, лазер и уходовые процедуры, продвигаюсь в Instagram...\n\n"
+                f"Часовой пояс сейчас {DEFAULT_TZ}, поменять: /tz Europe/Moscow")
+    if not sub:
+        return None
+    if command == "/profile":
+        if not arg:
+            return f"Твой профиль:\n{sub['profile'] or '(пусто)'}\n\nИзменить: /profile текст"
+        update_subscriber(chat_id, "profile", arg)
+        return "✅ Профиль обновлён"
+    if command == "/tz":
+        try:
+            ZoneInfo(arg)
+        except Exception:
+            return "Не знаю такой часовой пояс. Пример: /tz Asia/Jerusalem"
+        update_subscriber(chat_id, "tz", arg)
+        return f"✅ Часовой пояс: {arg}"
+    if command == "/stop":
+        if chat_id == MY_CHAT_ID:
+            return "Владельца отписать нельзя 🙂"
+        with db_lock:
+            db.execute("DELETE FROM subscribers WHERE chat_id = ?", (chat_id,))
+            db.commit()
+        return "Ок, больше не пишу. Вернуться: /join код"
+    return None
+
+def base_prompt_for(sub):
+    if sub["chat_id"] == MY_CHAT_ID:
+        return BASE_PROMPT
+    return f"{GUEST_PROMPT}\n\nКТО ОН:\n{sub['profile']}\n- Обращайся: {sub['name']}"
+
+def personal_prompt_for(sub):
+    return OWNER_PERSONAL_PROMPT if sub["chat_id"] == MY_CHAT_ID else GUEST_PERSONAL_PROMPT
+
+def coach_prompt_for(sub):
+    if sub["chat_id"] == MY_CHAT_ID:
+        return OWNER_COACH_PROMPT
+    return f"{GUEST_COACH_PROMPT}\n\nКТО ОН:\n{sub['profile']}\n- Обращайся: {sub['name']}"
 
 # ============================================================
-# BOT PERSONALITY
+# CLAUDE API
 # ============================================================
-BASE_PROMPT = """Ты — личный мотивационный коуч в Telegram для Михаила Соломоновича.
+# Prompt caching: the static personality prompts and the day's shared block
+# (the facts, or the slot's story for personalization) are sent as separate
+# system blocks marked cacheable, in this order:
+#   static prompt | shared block of the day | slot suffix or subscriber profile
+# so every call that day starting with the same static prompt reuses its prefix.
+cache_stats = {"calls": 0, "hits": 0, "misses": 0, "input_tokens": 0,
+               "cache_read_tokens": 0, "cache_write_tokens": 0, "output_tokens": 0}
+cache_stats_lock = threading.Lock()
 
-КТО ОН:
-- Предприниматель, владелец клиники красоты iStudio в Ришон-ле-Ционе (ул. Моше Леви 11, здание UMI, 5 этаж, офис 520)
+def cached_block(text):
+    return {"type": "text", "text": text, "cache_control": {"type": "ephemeral"}}
+
+def static_prompts():
+    return [BASE_PROMPT, OWNER_COACH_PROMPT, STORY_PROMPT, OWNER_PERSONAL_PROMPT, GUEST_PERSONAL_PROMPT,
+            GUEST_PROMPT, GUEST_COACH_PROMPT]
+
+def system_blocks(system_prompt, facts=None):
+    static, suffix = system_prompt, ""
+    for prompt in static_prompts():
+        if system_prompt.startswith(prompt) and system_prompt != prompt:
+            static, suffix = prompt, system_prompt[len(prompt):].lstrip("\n")
+            break
+    blocks = [cached_block(static)]
+    if facts:
+        blocks.append(cached_block(facts))
+    if suffix:
+        blocks.append(cached_block(suffix))
+    return blocks
+
+def claude_request(system_prompt, user_content, max_tokens, facts=None, model=CLAUDE_MODEL):
+    """Keyword arguments for messages.create / messages.stream."""
+    return {
+        "model": model,
+        "max_tokens": max_tokens,
+        "system": system_blocks(system_prompt, facts),
+        "messages": [{"role": "user", "content": user_content + used_note(facts)}],
+    }
+
+def record_usage(usage):
+    read = getattr(usage, "cache_read_input_tokens", 0) or 0
+    written = getattr(usage, "cache_creation_input_tokens", 0) or 0
+    with cache_stats_lock:
+        cache_stats["calls"] += 1
+        cache_stats["hits" if read else "misses"] += 1
+        cache_stats["input_tokens"] += usage.input_tokens
+        cache_stats["cache_read_tokens"] += read
+        cache_stats["cache_write_tokens"] += written
+        cache_stats["output_tokens"] += usage.output_tokens
+        hit_rate = cache_stats["hits"] / cache_stats["calls"]
+    inc("motivator_claude_calls_total", cache="hit" if read else "miss")
+    tokens = {"input": usage.input_tokens, "cache_read": read, "cache_write": written, "output": usage.output_tokens}
+    for kind, n in tokens.items():
+        inc("motivator_tokens_total", n, kind=kind)
+        trace_add(f"tokens_{kind}", n)
+    trace_add("claude_calls")
+    print(f"Claude usage: in={usage.input_tokens} cached={read} written={written} "
+          f"out={usage.output_tokens} (cache hit rate {hit_rate:.0%})")
+
+class CircuitBreaker:
+    """Fails fast after `threshold` failures in a row.
+
+    While open, one trial call is let through per `cooldown`; a success
+    closes it again.
+    """
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                return False
+            if self.failures >= self.threshold:
+                self.blocked_until = now + self.cooldown
+            return True
+
+    def success(self):
+        with self.lock:
+            if self.failures >= self.threshold:
+                print("🔌 Claude is back, circuit closed")
+            self.failures = 0
+            self.blocked_until = 0.0
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures == self.threshold:
+                print(f"🔌 Claude failing, circuit open for {self.cooldown:.0f}s")
+            if self.failures >= self.threshold:
+                self.blocked_until = time.monotonic() + self.cooldown
+
+claude_breaker = CircuitBreaker(CLAUDE_BREAKER_FAILURES, CLAUDE_BREAKER_COOLDOWN)
+
+def claude_deadline(budget):
+    """Monotonic deadline for a call with the named budget ("chat" or "slot")."""
+    return time.monotonic() + CLAUDE_BUDGETS[budget]
+
+# Fallback models the API answered 404 for (retired or mistyped); not tried again
+missing_models = set()
+
+def claude_model(deadline, budget):
+    """The main model, or the fallback once most of the budget is spent."""
+    if (CLAUDE_FALLBACK_MODEL and CLAUDE_FALLBACK_MODEL not in missing_models
+            and deadline - time.monotonic() < CLAUDE_BUDGETS[budget] * CLAUDE_FALLBACK_SHARE):
+        return CLAUDE_FALLBACK_MODEL
+    return CLAUDE_MODEL
+
+def retryable(error):
+    if isinstance(error, anthropic.APIConnectionError):
+        return True
+    return isinstance(error, anthropic.APIStatusError) and (error.status_code == 429 or error.status_code >= 500)
+
+def retry_delay(error, attempt):
+    """The server's retry-after if it sent one, otherwise exponential backoff with full jitter."""
+    response = getattr(error, "response", None)
+    try:
+        return float(response.headers["retry-after"])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return random.uniform(0, min(CLAUDE_BACKOFF_CAP, CLAUDE_BACKOFF_BASE * 2 ** attempt))
+
+def claude_failure(error, attempt, retries, deadline, model=CLAUDE_MODEL):
+    """Account for a failed attempt. Returns the seconds to wait before retrying, or None to give up."""
+    status = getattr(error, "status_code", None) or type(error).__name__
+    if model != CLAUDE_MODEL and isinstance(error, anthropic.NotFoundError):
+        # The fallback is gone; the call carries on with the main model
+        missing_models.add(model)
+        print(f"Claude model {model} not found, staying on {CLAUDE_MODEL}")
+        return 0
+    if not retryable(error):
+        # The API answered; the request itself was wrong
+        claude_breaker.success()
+        inc("motivator_claude_errors_total", status=status)
+        print(f"Claude error: {status} {error}")
+        return None
+    claude_breaker.failure()
+    delay = retry_delay(error, attempt)
+    if attempt == retries - 1 or time.monotonic() + delay >= deadline:
+        inc("motivator_claude_errors_total", status=status)
+        print(f"Claude error: {status}, giving up")
+        return None
+    inc("motivator_claude_retries_total")
+    trace_add("claude_retries")
+    print(f"Claude error: {status}, retrying in {delay:.1f}s")
+    return delay
+
+def claude_unavailable():
+    """True (and counted) when the breaker is open and the call should fail fast."""
+    if claude_breaker.allow():
+        return False
+    inc("motivator_claude_errors_total", status="circuit_open")
+    return True
+
+def call_claude(system_prompt, user_content, max_tokens=4000, retries=5, facts=None, budget="slot", deadline=None):
+    """One Claude answer within the caller's budget, or None.
+
+    Retries 429, 5xx and timeouts until `deadline` (by default the named
+    budget from now), switching to the fallback model near the end.
+    """
+    deadline = deadline or claude_deadline(budget)
+    with stage("claude"):
+        for attempt in range(retries):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or claude_unavailable():
+                return None
+            model = claude_model(deadline, budget)
+            try:
+                response = claude.messages.create(
+                    **claude_request(system_prompt, user_content, max_tokens, facts, model), timeout=remaining)
+            except Exception as e:
+                delay = claude_failure(e, attempt, retries, deadline, model)
+                if delay is None:
+                    return None
+                time.sleep(delay)
+                continue
+            claude_breaker.success()
+            record_usage(response.usage)
+            return response.content[0].text
+    return None
+
+# ============================================================
+# BOT PERSONALITY
+# ============================================================
+OWNER_NAME = "Михаил Соломонович"
+OWNER_PROFILE = """- Предприниматель, владелец клиники красоты iStudio в Ришон-ле-Ционе (ул. Моше Леви 11, здание UMI, 5 этаж, офис 520)
 - Контакт: 053-4488475. График: Вс-Чт 09:00-19:00, Пт 09:00-15:00, Сб закрыто
 - Использует индивидуальный подход к клиентам, доступен в WhatsApp 24/7
 - Оборудование: американский аппарат VECTUS, процедуры MOXI и BBL
 - Работает над GlowNow — CRM/маркетинговая платформа для бьюти-индустрии с социальной составляющей (адаптация для людей с ограниченными возможностями)
 - Интересуется технологиями: интеграции (Oura + Make.com), self-hosted решения, AI-ассистенты
 - Создаёт премиальный видео-контент и рекламные сценарии
-- Семья, второй бизнес, здоровье и саморазвитие
-- Обращайся: "Михаил Соломонович" или "Соломонович"
+- Семья, второй бизнес, здоровье и саморазвитие"""
 
-АБСОЛЮТНЫЙ ЗАПРЕТ НА ФОРМАТИРОВАНИЕ:
+RULES = """АБСОЛЮТНЫЙ ЗАПРЕТ НА ФОРМАТИРОВАНИЕ:
 Не используй звёздочки (*), двойные звёздочки (**), подчёркивания (_), решётки (#), обратные кавычки (`) или любую Markdown-разметку. ТОЛЬКО чистый текст и эмодзи. Для выделения используй ЗАГЛАВНЫЕ БУКВЫ. Это КРИТИЧЕСКИ ВАЖНОЕ правило — нарушение недопустимо.
 
 ГЛАВНОЕ — ФАКТЫ:
@@ -163,9 +1180,9 @@ BASE_PROMPT = """Ты — личный мотивационный коуч в Te
 - Русский, сочный, с энергией
 - 2500-3500 символов — БОЛЬШЕ конкретики, деталей, имён, цифр, дат
 - Каждое сообщение = мини-история которую хочется дочитать до конца
-- Не бойся длинных сообщений — главное чтобы было ИНТЕРЕСНО
+- Не бойся длинных сообщений — главное чтобы было ИНТЕРЕСНО"""
 
-ОБЯЗАТЕЛЬНО В КАЖДОМ СООБЩЕНИИ — "СДЕЛАЙ ПРЯМО СЕЙЧАС":
+OWNER_ACTION_RULES = """ОБЯЗАТЕЛЬНО В КАЖДОМ СООБЩЕНИИ — "СДЕЛАЙ ПРЯМО СЕЙЧАС":
 - Один конкретный совет-действие привязанный к iStudio или GlowNow
 - НЕ общие слова типа "улучши сервис" или "работай над маркетингом"
 - А ТОЧНЫЕ ШАГИ: "Открой WhatsApp → найди 3 клиентов которые были на карбоновом пилинге в январе → напиши: Привет! Как кожа после процедуры? Есть вопросы по уходу?"
@@ -174,7 +1191,24 @@ BASE_PROMPT = """Ты — личный мотивационный коуч в Te
 - Совет должен быть ВЫПОЛНИМ за 5-15 минут прямо сейчас
 - Привязывай к конкретным процедурам: лазерная эпиляция (VECTUS), карбоновый пилинг, BBL, MOXI, эндосфера, массаж"""
 
-MORNING_PROMPT = BASE_PROMPT + """
+BASE_PROMPT = """Ты — личный мотивационный коуч в Telegram для Михаила Соломоновича.
+
+КТО ОН:
+""" + OWNER_PROFILE + """
+- Обращайся: "Михаил Соломонович" или "Соломонович"
+
+""" + RULES + """
+
+""" + OWNER_ACTION_RULES
+
+# Shared story of a slot: generated once per date for all subscribers, with no
+# personal details; each subscriber then gets a short personal part on top.
+STORY_PROMPT = """Ты — автор ежедневной мотивационной рассылки в Telegram для предпринимателей, владельцев клиник и салонов красоты.
+Это общая часть сообщения для всех читателей: не обращайся по имени и не упоминай конкретный бизнес — персональная часть будет добавлена отдельно.
+
+""" + RULES
+
+MORNING_PROMPT = STORY_PROMPT + """
 
 УТРО (07:00) — ЗАРЯД
 Тон: крепкий эспрессо. Бодрый, дерзкий.
@@ -185,11 +1219,10 @@ MORNING_PROMPT = BASE_PROMPT + """
 3. Ещё 3-4 коротких факта этого дня (по 2 предложения каждый) — удивляющие, с конкретикой
 4. Кто родился в этот день — выбери самого интересного человека, расскажи его историю в 3-4 предложениях
 5. Цитата (НЕ банальная — не "верь в себя", а острая и неожиданная, с указанием автора)
-6. Связь с бизнесом Соломоновича — как урок дня применим к iStudio или GlowNow
-7. Шутка или ирония — одна смешная фраза для настроения
-8. Пинок на день — одно мощное предложение"""
+6. Шутка или ирония — одна смешная фраза для настроения
+7. Пинок на день — одно мощное предложение"""
 
-DAY_PROMPT = BASE_PROMPT + """
+DAY_PROMPT = STORY_PROMPT + """
 
 ДЕНЬ (13:00) — ПЕРЕЗАГРУЗКА
 Тон: умный друг за обедом. С перчинкой.
@@ -199,10 +1232,9 @@ DAY_PROMPT = BASE_PROMPT + """
 2. Два факта дня которые НЕ были утром — с подробностями
 3. Бизнес-совет — ОЧЕНЬ конкретный, применимый сегодня. Не общие слова а конкретная тактика с примером. Например: "Возьми телефон, открой WhatsApp, напиши 3 клиентам которые были месяц назад — просто спроси как результат процедуры"
 4. Израильский стартап — КОНКРЕТНАЯ история: название, основатель, что сделали, сколько подняли, что необычного. Малоизвестный лучше.
-5. Бизнес-юмор — ОБЯЗАТЕЛЬНО смешная история или анекдот про бизнес/предпринимательство. Не плоская шутка, а реально смешная ситуация из жизни бизнеса. 3-5 предложений. Можно из израильской бизнес-культуры.
-6. Поддержка — тёплые слова, напомни что он молодец и делает больше чем думает. 2-3 предложения с конкретикой про его достижения (iStudio, GlowNow, технологии)."""
+5. Бизнес-юмор — ОБЯЗАТЕЛЬНО смешная история или анекдот про бизнес/предпринимательство. Не плоская шутка, а реально смешная ситуация из жизни бизнеса. 3-5 предложений. Можно из израильской бизнес-культуры."""
 
-EVENING_PROMPT = BASE_PROMPT + """
+EVENING_PROMPT = STORY_PROMPT + """
 
 ВЕЧЕР (21:00) — РЕФЛЕКСИЯ
 Тон: мудрый наставник. Спокойный, глубокий, не занудный.
@@ -212,188 +1244,1572 @@ EVENING_PROMPT = BASE_PROMPT + """
 2. ИСТОРИЯ ПРЕОДОЛЕНИЯ — подробная (10-15 предложений). Кто, когда, что случилось, как упал, что сделал, чем закончилось. С конкретными цифрами, датами, именами. Малоизвестная история лучше чем Стив Джобс или Илон Маск.
 3. Урок из этой истории — как это применимо к предпринимателю
 4. Факт дня — один удивительный, которого не было утром и днём
-5. Вопрос для рефлексии — КОНКРЕТНЫЙ. "Какой один звонок завтра может изменить следующий месяц в iStudio?" или "Если бы у тебя остался только один рекламный канал — какой бы выбрал и почему?"
-6. Тёплый финал — по-мужски, с уважением. Напомни что два бизнеса, семья, технологии — это реально много. Он справляется лучше чем думает. 2-3 предложения искренней поддержки."""
+5. Вопрос для рефлексии — КОНКРЕТНЫЙ. "Какой один звонок завтра может изменить следующий месяц?" или "Если бы у тебя остался только один рекламный канал — какой бы выбрал и почему?\""""
+
+ACTION_RULES = """ОБЯЗАТЕЛЬНО — "СДЕЛАЙ ПРЯМО СЕЙЧАС":
+- Один конкретный совет-действие привязанный к бизнесу получателя из его профиля
+- НЕ общие слова типа "улучши сервис" или "работай над маркетингом"
+- А ТОЧНЫЕ ШАГИ: "Открой WhatsApp → найди 3 клиентов которые были на процедуре месяц назад → напиши: Привет! Как результат? Есть вопросы по уходу?"
+- Совет должен быть ВЫПОЛНИМ за 5-15 минут прямо сейчас
+- Привязывай к конкретным услугам, каналам и инструментам из профиля"""
+
+# Personal part appended to the shared story for each subscriber: a shared
+# prefix, then the owner's or a guest's structure and action rules
+PERSONAL_PROMPT = """Ты — личный мотивационный коуч в Telegram. Получатель только что прочитал общую историю дня (она дана ниже). Допиши к ней короткую ПЕРСОНАЛЬНУЮ часть — только её, историю не повторяй.
+
+Не используй звёздочки, подчёркивания, решётки или любую Markdown-разметку. ТОЛЬКО чистый текст и эмодзи."""
+
+OWNER_PERSONAL_PROMPT = PERSONAL_PROMPT + """
+
+Структура (600-1000 символов):
+1. Связь с бизнесом Соломоновича — как урок дня применим к iStudio или GlowNow, 2-3 предложения. Обращайся: "Михаил Соломонович" или "Соломонович"
+2. СДЕЛАЙ ПРЯМО СЕЙЧАС — по правилам ниже
+3. Тёплая поддержка — 1-2 предложения, напомни что он делает больше чем думает
+
+""" + OWNER_ACTION_RULES
+
+GUEST_PERSONAL_PROMPT = PERSONAL_PROMPT + """
+
+Структура (600-1000 символов):
+1. Обращение по имени и как урок истории применим к его бизнесу — 2-3 предложения с конкретикой из профиля
+2. СДЕЛАЙ ПРЯМО СЕЙЧАС — по правилам ниже
+3. Тёплая поддержка — 1-2 предложения, напомни что он делает больше чем думает
+
+""" + ACTION_RULES
+
+# Interactive replies for subscribers other than the owner; their profile is appended
+GUEST_PROMPT = """Ты — личный мотивационный коуч в Telegram для предпринимателя.
+
+""" + RULES + """
+
+""" + ACTION_RULES
+
+# Free-text coach replies: a shared prefix, then the owner's or a guest's profile and action rules
+COACH_PROMPT = """Ты — мотивационный коуч предпринимателя в Telegram.
+
+ПРАВИЛО: В КАЖДОМ ответе — ОБЯЗАТЕЛЬНО один малоизвестный исторический факт, который произошёл ИМЕННО В ЭТОТ ДЕНЬ в истории. Из этого факта выведи совет или поддержку.
+
+Структура ответа:
+1. Ответ на его вопрос/реплику (2-3 предложения)
+2. Исторический факт этого дня (3-5 предложений с деталями: имена, даты, цифры)
+3. Связь факта с его ситуацией — совет или поддержка (2-3 предложения)
+
+НЕ используй звёздочки, подчёркивания или Markdown — ТОЛЬКО чистый текст и эмодзи."""
+
+OWNER_COACH_PROMPT = COACH_PROMPT + """
+
+КТО ОН:
+""" + OWNER_PROFILE + """
+- Обращайся: Соломонович, Дорогой, Дружище или Михаил Соломонович
+
+""" + OWNER_ACTION_RULES
+
+GUEST_COACH_PROMPT = COACH_PROMPT + """
+
+""" + ACTION_RULES
 
 # ============================================================
 # SAFE SEND
 # ============================================================
-def safe_send(chat_id, text, max_len=4000):
-    if not text:
-        text = "Мотиватор задумался..."
-    if len(text) <= max_len:
+def split_point(text, max_len):
+    """Where to cut text longer than max_len: last paragraph break, else last line break, else hard cut."""
+    split_at = text.rfind("\n\n", 0, max_len)
+    if split_at == -1:
+        split_at = text.rfind("\n", 0, max_len)
+    if split_at == -1:
+        split_at = max_len
+    return split_at
+
+def split_message(text, max_len=4000):
+    """Cut text into parts of at most max_len in one forward pass, at the same places split_point would."""
+    parts = []
+    start, end = 0, len(text)
+    while end - start > max_len:
+        cut = text.rfind("\n\n", start, start + max_len)
+        if cut == -1:
+            cut = text.rfind("\n", start, start + max_len)
+        if cut == -1:
+            cut = start + max_len
+        # A break right at the start leaves nothing to send before it
+        if cut > start:
+            parts.append(text[start:cut])
+        start = cut
+        while start < end and text[start] == "\n":
+            start += 1
+    if start < end:
+        parts.append(text[start:])
+    return parts
+
+def sent_message(ok):
+    inc("motivator_telegram_messages_total" if ok else "motivator_telegram_errors_total")
+    trace_add("chunks" if ok else "send_errors")
+
+# Outgoing parts go through a persistent outbox: they're stored before
+# anything is sent and deleted once Telegram accepts them, so a restart
+# resumes with whatever was left. Each process holds a lease on the rows it
+# queued and renews it while running; rows whose lease lapsed (a replica that
+# died, the previous run) are claimed by one live process in a single UPDATE,
+# so replicas sharing the file never send each other's parts. One part per chat is in flight at a time,
+# which keeps multi-part messages in order; token buckets keep the pace
+# under Telegram's limits (streamed replies draw on the same buckets), and
+# a 429 holds back every chat for exactly the retry_after asked for.
+with db_lock:
+    db.execute("""CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER NOT NULL,
+        part TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        owner TEXT,
+        lease_until REAL NOT NULL DEFAULT 0)""")
+    if "owner" not in {row[1] for row in db.execute("PRAGMA table_info(outbox)")}:
+        # Rows queued before leases come up already expired, so the next run claims them
+        db.execute("ALTER TABLE outbox ADD COLUMN owner TEXT")
+        db.execute("ALTER TABLE outbox ADD COLUMN lease_until REAL NOT NULL DEFAULT 0")
+    db.commit()
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait(self, now):
+        """Seconds until a token is available."""
+        self.refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self.refill(now)
+        self.tokens -= 1
+
+    def full(self, now):
+        self.refill(now)
+        return self.tokens >= self.burst
+
+class Outbox:
+    """Per-chat FIFO queues of message parts, handed out to senders as rate limits allow.
+
+    A queued part is [row_id, text, created_at, attempts].
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.chats = OrderedDict()
+        self.busy = set()
+        self.ready_at = {}
+        self.buckets = {}
+        self.global_bucket = TokenBucket(SEND_RATE, SEND_RATE)
+        # Nothing goes out before this (monotonic) time after a 429
+        self.paused_until = 0
+        self.wakeup = threading.Event()
+        # When keep_lease() next renews our rows and looks for abandoned ones (monotonic)
+        self.lease_check_at = 0
+
+    def claim(self):
+        """Take over parts whose lease ran out: left by the previous run or by a replica that died."""
+        now = time.time()
+        with self.lock:
+            with db_lock:
+                rows = db.execute("UPDATE outbox SET owner = ?, lease_until = ? WHERE lease_until < ? AND owner IS NOT ? "
+                                  "RETURNING id, chat_id, part, created_at",
+                                  (OUTBOX_OWNER, now + OUTBOX_LEASE, now, OUTBOX_OWNER)).fetchall()
+                db.commit()
+            claimed = set()
+            for row_id, chat_id, part, created_at in sorted(rows):
+                self.chats.setdefault(chat_id, deque()).append([row_id, part, created_at, 0])
+                claimed.add(chat_id)
+            for chat_id in claimed:
+                # Older rows go ahead of what we queued since, but not ahead of a part in flight
+                waiting = self.chats[chat_id]
+                head = [waiting.popleft()] if chat_id in self.busy else []
+                self.chats[chat_id] = deque(head + sorted(waiting))
+        if rows:
+            print(f"📬 Resuming {len(rows)} undelivered message parts")
+            self.wake()
+
+    def keep_lease(self):
+        """Renew the lease on our rows and claim abandoned ones when due; seconds until the next check."""
+        now = time.monotonic()
+        if now >= self.lease_check_at:
+            self.lease_check_at = now + OUTBOX_LEASE / 3
+            with db_lock:
+                db.execute("UPDATE outbox SET lease_until = ? WHERE owner = ?",
+                           (time.time() + OUTBOX_LEASE, OUTBOX_OWNER))
+                db.commit()
+            self.claim()
+        return max(self.lease_check_at - now, 0)
+
+    def put(self, messages):
+        """Queue [(chat_id, parts)] for delivery; each chat's parts go out in the order given."""
+        now = time.time()
+        with self.lock:
+            with db_lock:
+                for chat_id, parts in messages:
+                    waiting = self.chats.setdefault(chat_id, deque())
+                    for part in parts:
+                        row_id = db.execute("INSERT INTO outbox (chat_id, part, created_at, owner, lease_until) "
+                                            "VALUES (?, ?, ?, ?, ?)",
+                                            (chat_id, part, now, OUTBOX_OWNER, now + OUTBOX_LEASE)).lastrowid
+                        waiting.append([row_id, part, now, 0])
+                db.commit()
+            self.prune_buckets(time.monotonic())
+        self.wake()
+
+    def wake(self):
+        self.wakeup.set()
+        if "outbox_wakeup" in async_state:
+            async_state["loop"].call_soon_threadsafe(async_state["outbox_wakeup"].set)
+
+    def bucket(self, chat_id):
+        if chat_id not in self.buckets:
+            # Negative ids are groups and channels
+            rate = SEND_CHAT_RATE if chat_id > 0 else SEND_GROUP_RATE
+            self.buckets[chat_id] = TokenBucket(rate, SEND_CHAT_BURST)
+        return self.buckets[chat_id]
+
+    def prune_buckets(self, now):
+        if len(self.buckets) > 2 * len(self.chats) + 64:
+            for chat_id in [c for c, b in self.buckets.items() if c not in self.chats and b.full(now)]:
+                del self.buckets[chat_id]
+
+    def delay(self, chat_id, now):
+        """Seconds until the chat may be sent to again; call with the lock held."""
+        return max(self.paused_until - now, self.ready_at.get(chat_id, 0) - now,
+                   self.bucket(chat_id).wait(now), self.global_bucket.wait(now))
+
+    def take(self):
+        """The next part allowed to go out, as ((chat_id, part), 0).
+
+        Otherwise (None, seconds until one may be ready), or (None, None)
+        when everything is delivered or in flight.
+        """
+        with self.lock:
+            now = time.monotonic()
+            wait = None
+            for chat_id, parts in self.chats.items():
+                if chat_id in self.busy:
+                    continue
+                delay = self.delay(chat_id, now)
+                if delay > 0:
+                    wait = delay if wait is None else min(wait, delay)
+                    continue
+                self.bucket(chat_id).take(now)
+                self.global_bucket.take(now)
+                self.busy.add(chat_id)
+                # Round-robin between chats
+                self.chats.move_to_end(chat_id)
+                return (chat_id, parts[0]), 0
+            return None, wait
+
+    def reserve(self, chat_id):
+        """Take the tokens for a message or edit sent outside the queue (streamed replies).
+
+        Returns 0 once taken, otherwise the seconds to wait before asking again.
+        """
+        with self.lock:
+            now = time.monotonic()
+            delay = self.delay(chat_id, now)
+            if delay > 0:
+                return delay
+            self.bucket(chat_id).take(now)
+            self.global_bucket.take(now)
+            return 0
+
+    def acquire(self, chat_id):
+        while True:
+            delay = self.reserve(chat_id)
+            if not delay:
+                return
+            time.sleep(delay)
+
+    def pause(self, seconds):
+        """Telegram said 429: hold back every chat, not only the one that hit it."""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def finish(self, chat_id, part, retry_in=None, drop_chat=False):
+        """Settle a part handed out by take().
+
+        With `retry_in` it's tried again after that many seconds; otherwise it's
+        removed, together with the rest of the chat's queue if `drop_chat`.
+        """
+        with self.lock:
+            self.busy.discard(chat_id)
+            waiting = self.chats[chat_id]
+            if retry_in is not None:
+                part[3] += 1
+                self.ready_at[chat_id] = time.monotonic() + retry_in
+            else:
+                done = list(waiting) if drop_chat else [waiting.popleft()]
+                if drop_chat:
+                    waiting.clear()
+                if not waiting:
+                    del self.chats[chat_id]
+                    self.ready_at.pop(chat_id, None)
+                with db_lock:
+                    db.executemany("DELETE FROM outbox WHERE id = ?", [(p[0],) for p in done])
+                    db.commit()
+                self.changed.notify_all()
+        self.wake()
+
+    def pending(self, chat_id):
+        with self.lock:
+            return chat_id in self.chats
+
+    def size(self):
+        with self.lock:
+            return sum(len(q) for q in self.chats.values())
+
+    def wait_delivered(self, chat_id=None, timeout=None):
+        """Block until nothing is queued for the chat (or for anybody); False on timeout."""
+        with self.changed:
+            return self.changed.wait_for(lambda: chat_id not in self.chats if chat_id is not None else not self.chats,
+                                         timeout)
+
+outbox = Outbox()
+send_pool = ThreadPoolExecutor(max_workers=SEND_WORKERS, thread_name_prefix="send")
+
+def retry_after(error):
+    """Seconds Telegram asked to wait if the error is a 429, else None; a 429 pauses the whole outbox."""
+    if getattr(error, "error_code", None) != 429:
+        return None
+    seconds = float(((getattr(error, "result_json", None) or {}).get("parameters") or {}).get("retry_after", 5))
+    outbox.pause(seconds)
+    return seconds
+
+def send_failure(error, attempts):
+    """What to do after a failed send: ("retry", seconds), ("drop", None) or ("drop_chat", None)."""
+    code = getattr(error, "error_code", None)
+    if code == 429:
+        return "retry", retry_after(error)
+    if code == 403:
+        # Blocked or kicked: nothing queued for this chat will get through
+        return "drop_chat", None
+    if code is not None and code < 500:
+        return "drop", None
+    if attempts + 1 >= SEND_MAX_ATTEMPTS:
+        return "drop", None
+    return "retry", min(60, 2 ** attempts) + random.uniform(0, 1)
+
+def delivered(chat_id, part):
+    inc("motivator_telegram_messages_total")
+    observe("motivator_outbox_delay_seconds", time.time() - part[2])
+    outbox.finish(chat_id, part)
+
+def delivery_failed(chat_id, part, error):
+    action, delay = send_failure(error, part[3])
+    inc("motivator_telegram_errors_total")
+    print(f"Send error ({action}): {error}")
+    outbox.finish(chat_id, part, delay, drop_chat=action == "drop_chat")
+
+def deliver(chat_id, part):
+    with stage("telegram"):
         try:
-            bot.send_message(chat_id, text)
+            bot.send_message(chat_id, part[1])
         except Exception as e:
-            print(f"Send error: {e}")
-        return
-    parts = []
-    while text:
-        if len(text) <= max_len:
-            parts.append(text)
-            break
-        split_at = text.rfind("\n\n", 0, max_len)
-        if split_at == -1:
-            split_at = text.rfind("\n", 0, max_len)
-        if split_at == -1:
-            split_at = max_len
-        parts.append(text[:split_at])
-        text = text[split_at:].lstrip("\n")
-    for part in parts:
+            delivery_failed(chat_id, part, e)
+            return
+    delivered(chat_id, part)
+
+def run_outbox():
+    while True:
+        outbox.wakeup.clear()
+        lease_check = outbox.keep_lease()
+        item, wait = outbox.take()
+        if item:
+            send_pool.submit(deliver, *item)
+        else:
+            outbox.wakeup.wait(lease_check if wait is None else min(wait, lease_check))
+
+def start_outbox():
+    threading.Thread(target=run_outbox, daemon=True, name="outbox").start()
+
+def safe_send_many(messages, max_len=4000):
+    """Queue [(chat_id, text)] for delivery without waiting for Telegram."""
+    batch = [(chat_id, split_message(text or "Мотиватор задумался...", max_len)) for chat_id, text in messages]
+    trace_add("chunks", sum(len(parts) for _, parts in batch))
+    outbox.put(batch)
+
+def safe_send(chat_id, text, max_len=4000):
+    safe_send_many([(chat_id, text)], max_len)
+
+# ============================================================
+# STREAMING REPLIES
+# ============================================================
+STREAM_BROKEN_NOTICE = "⚠️ Ответ оборвался на полуслове — повтори запрос чуть позже."
+
+def safe_edit(chat_id, message_id, text):
+    """Best-effort progress edit; the caller already holds a send token. False if it didn't land."""
+    try:
+        bot.edit_message_text(text, chat_id, message_id)
+    except Exception as e:
+        retry_after(e)
+        if "message is not modified" not in str(e):
+            print(f"Edit error: {e}")
+            return False
+    return True
+
+def paced_call(chat_id, deadline, call):
+    """Make a streamed reply's Telegram call within the send limits, retrying like the outbox does.
+
+    Raises the last error once send_failure gives up or the deadline is near.
+    """
+    attempt = 0
+    while True:
+        outbox.acquire(chat_id)
         try:
-            bot.send_message(chat_id, part)
-            time.sleep(0.3)
+            return call()
         except Exception as e:
-            print(f"Send error: {e}")
+            if "message is not modified" in str(e):
+                return None
+            action, delay = send_failure(e, attempt)
+            if action != "retry" or time.monotonic() + delay >= deadline:
+                raise
+            print(f"Telegram error (retry in {delay:.0f}s): {e}")
+            time.sleep(delay)
+            attempt += 1
+
+def stream_send(chat_id, text, deadline):
+    """Send one streamed message and return its id."""
+    try:
+        message_id = paced_call(chat_id, deadline, lambda: bot.send_message(chat_id, text).message_id)
+    except Exception:
+        sent_message(False)
+        raise
+    sent_message(True)
+    return message_id
+
+def stream_edit(chat_id, message_id, text, deadline):
+    """Edit that must land (a rolled-over or final message); raises if it can't."""
+    paced_call(chat_id, deadline, lambda: bot.edit_message_text(text, chat_id, message_id))
+
+class StreamBuffer:
+    """Turns streamed text chunks into Telegram message operations.
+
+    feed() returns a list of ("edit", text) for the current message and
+    ("new", text) to start the next one once max_len is crossed; the split
+    follows the same rules as safe_send. In between, ("progress", text)
+    shows the text so far, at most every STREAM_EDIT_INTERVAL; it may be
+    skipped, and skip() makes a later one repeat it.
+    """
+
+    def __init__(self, max_len=4000):
+        self.max_len = max_len
+        self.full = ""
+        self.offset = 0  # where the current Telegram message starts in full
+        self.shown = ""
+        self.last_edit = 0.0
+
+    def current(self):
+        return self.full[self.offset:].lstrip("\n")
+
+    def feed(self, chunk):
+        ops = []
+        self.full += chunk
+        current = self.current()
+        while len(current) > self.max_len:
+            split_at = split_point(current, self.max_len)
+            ops.append(("edit", current[:split_at]))
+            self.offset = len(self.full) - len(current) + split_at
+            current = self.current()
+            ops.append(("new", current or "✍️ ..."))
+            self.shown = current
+            self.last_edit = time.monotonic()
+        now = time.monotonic()
+        if current and current != self.shown and now - self.last_edit >= STREAM_EDIT_INTERVAL:
+            ops.append(("progress", current))
+            self.shown = current
+            self.last_edit = now
+        return ops
+
+    def skip(self):
+        self.shown = ""
+
+    def finish(self):
+        current = self.current()
+        if current and current != self.shown:
+            self.shown = current
+            return [("edit", current)]
+        return []
+
+def stream_claude(chat_id, system_prompt, user_content, max_tokens=4000, max_len=4000, facts=None, deadline=None):
+    """Stream a Claude reply into the chat, editing a placeholder as tokens arrive.
+
+    Returns the full text; None if the stream failed before producing anything;
+    "" if it broke off part-way (the user is told, and the truncated text must
+    not count as a reply).
+    """
+    deadline = deadline or claude_deadline("chat")
+    if claude_unavailable():
+        return None
+    # The placeholder goes out directly, so let anything queued for the chat go first
+    outbox.wait_delivered(chat_id, timeout=10)
+    try:
+        message_id = stream_send(chat_id, "✍️ ...", deadline)
+    except Exception as e:
+        print(f"Send error: {e}")
+        return None
+    buf = StreamBuffer(max_len)
+    broken = False
+    try:
+        with claude.messages.stream(**claude_request(system_prompt, user_content, max_tokens, facts),
+                                    timeout=max(1.0, deadline - time.monotonic())) as stream:
+            for chunk in stream.text_stream:
+                for op, text in buf.feed(chunk):
+                    if op == "new":
+                        message_id = stream_send(chat_id, text, deadline)
+                    elif op == "edit":
+                        stream_edit(chat_id, message_id, text, deadline)
+                    elif outbox.reserve(chat_id) or not safe_edit(chat_id, message_id, text):
+                        # No token free, or the progress edit failed; a later edit shows the text instead
+                        buf.skip()
+            record_usage(stream.get_final_message().usage)
+        claude_breaker.success()
+    except Exception as e:
+        if retryable(e):
+            claude_breaker.failure()
+        print(f"Claude stream error: {e}")
+        if not buf.full:
+            try:
+                bot.delete_message(chat_id, message_id)
+            except Exception:
+                pass
+            return None
+        broken = True
+    try:
+        for op, text in buf.finish():
+            stream_edit(chat_id, message_id, text, deadline)
+    except Exception as e:
+        print(f"Edit error: {e}")
+        broken = True
+    if broken:
+        trace_add("stream_broken")
+        safe_send(chat_id, STREAM_BROKEN_NOTICE)
+        return ""
+    return buf.full
+
+def reply_claude(chat_id, system_prompt, user_content, max_tokens=4000, facts=None):
+    """Answer in chat: streamed when enabled, otherwise one blocking call and safe_send.
+
+    Both share one "chat" budget, so a failed stream leaves the fallback only what's left of it.
+    A stream that broke off part-way returns "" rather than falling back and repeating itself.
+    """
+    deadline = claude_deadline("chat")
+    if STREAM_REPLIES:
+        with stage("claude_stream"):
+            response = stream_claude(chat_id, system_prompt, user_content, max_tokens, facts=facts, deadline=deadline)
+        if response is not None:
+            return response
+    response = call_claude(system_prompt, user_content, max_tokens, facts=facts, budget="chat", deadline=deadline)
+    if response:
+        safe_send(chat_id, response)
+    return response
 
 # ============================================================
 # SCHEDULED MESSAGES
 # ============================================================
+# Every slot is built in two layers: one shared story per local date (facts,
+# main story, quote...) generated once for everybody, then a short personal
+# part per subscriber, generated in parallel with bounded concurrency.
+SLOT_HOURS = {"morning": 7, "afternoon": 13, "evening": 21}
+SLOT_ORDER = ["morning", "afternoon", "evening"]
+# Minutes before the slot its generation starts; PREGEN_LEAD_MORNING etc. override the default
+SLOT_LEAD_MINUTES = {slot: int(os.environ.get(f"PREGEN_LEAD_{slot.upper()}", PREGEN_LEAD_MINUTES))
+                     for slot in SLOT_HOURS}
+SLOT_TITLES = {"morning": "утреннее (07:00)", "afternoon": "дневное (13:00)", "evening": "вечернее (21:00)"}
+
+# Shared story of a slot: (date, slot) -> text
+stories = {}
+# Personalized messages ready to send: (chat_id, date, slot) -> text
+ready_messages = {}
+# (tz, date, slot) -> Event set once pre-generation for that group finished
+preparing = {}
+ready_lock = threading.Lock()
+# Serializes story generation so later slots always see the facts earlier slots used
+generation_lock = threading.Lock()
+personal_pool = ThreadPoolExecutor(max_workers=PERSONALIZE_CONCURRENCY, thread_name_prefix="personalize")
+
+def today_key(now=None):
+    return (now or get_israel_now()).strftime("%Y-%m-%d")
+
+def build_slot_prompt(slot):
+    """System prompt and user message for a slot's shared story; the facts go in a separate cached block."""
+    if slot == "morning":
+        prompt = "Сгенерируй УТРЕННЕЕ сообщение. Выбери самые удивительные факты."
+        return MORNING_PROMPT, prompt
+    if slot == "afternoon":
+        prompt = "Сгенерируй ДНЕВНОЕ сообщение."
+        return DAY_PROMPT, prompt
+    prompt = "Сгенерируй ВЕЧЕРНЕЕ сообщение."
+    return EVENING_PROMPT, prompt
+
+def slot_fallback(slot, now=None):
+    if slot == "morning":
+        return f"☀️ {today_display(now)}\n\nClaude думает... Но ты не думай — действуй!"
+    if slot == "afternoon":
+        return "🍽 Сделай одну вещь которую откладывал. Прямо сейчас."
+    return "🌙 Чем сегодня будешь гордиться через год? Отдыхай."
+
+def stories_to_generate(slot, now):
+    """Slots whose story must be generated, in order, so that `slot` has one for the date of `now`.
+
+    Earlier slots of the date whose time hasn't come yet go first, so the
+    used-facts index is complete when later slots pick their facts.
+    """
+    date = today_key(now)
+    pending = [s for s in SLOT_ORDER[:SLOT_ORDER.index(slot)]
+               if (date, s) not in stories and now.hour < SLOT_HOURS[s]]
+    if (date, slot) not in stories:
+        pending.append(slot)
+    return pending
+
+def store_story(slot, now, story, facts):
+    if not story:
+        print(f"Story generation failed: {slot}")
+        return
+    mark_facts_used(facts, story, slot)
+    date = today_key(now)
+    stories[(date, slot)] = story
+    with ready_lock:
+        oldest = today_key(now - timedelta(days=2))
+        for key in [k for k in stories if k[0] < oldest]:
+            del stories[key]
+        for key in [k for k in ready_messages if k[1] < oldest]:
+            del ready_messages[key]
+
+def generate_story(slot, now):
+    facts = fetch_this_day_facts(now)
+    system_prompt, prompt = build_slot_prompt(slot)
+    return call_claude(system_prompt, prompt, facts=facts), facts
+
+def ensure_story(slot, now):
+    with generation_lock:
+        for s in stories_to_generate(slot, now):
+            story, facts = generate_story(s, now)
+            store_story(s, now, story, facts)
+        return stories.get((today_key(now), slot))
+
+def personal_request(sub, slot, story):
+    """User message and shared (cached) block for one subscriber's personal part."""
+    profile = sub["profile"] or "Профиль не заполнен — владелец бьюти-бизнеса."
+    prompt = (f"ПОЛУЧАТЕЛЬ: {sub['name']}\nПРОФИЛЬ:\n{profile}\n\n"
+              f"Сообщение: {SLOT_TITLES[slot]}. Напиши персональную часть.")
+    shared = f"ОБЩАЯ ИСТОРИЯ ДНЯ (получатель её уже прочитал):\n{story}"
+    return prompt, shared
+
+def with_personal(story, personal):
+    return f"{story}\n\n{personal}" if personal else story
+
+def personalize(sub, slot, story):
+    prompt, shared = personal_request(sub, slot, story)
+    return with_personal(story, call_claude(personal_prompt_for(sub), prompt, max_tokens=PERSONAL_MAX_TOKENS,
+                                            facts=shared))
+
+def prepare_slot(slot, subs, now):
+    """Slot messages for subscribers sharing the date of `now`: {chat_id: text}, or None if the story failed."""
+    story = ensure_story(slot, now)
+    if not story:
+        return None
+    # Each task runs in a copy of this context so its stages land in the caller's trace
+    futures = {sub["chat_id"]: personal_pool.submit(contextvars.copy_context().run, personalize, sub, slot, story)
+               for sub in subs}
+    return {chat_id: future.result() for chat_id, future in futures.items()}
+
+def pregenerate(slot, tz):
+    """Build a slot's messages for one time zone ahead of its deadline and keep them ready to send."""
+    now = local_now(tz)
+    key = (tz, today_key(now), slot)
+    with ready_lock:
+        if key in preparing:
+            return
+        preparing[key] = threading.Event()
+    try:
+        messages = prepare_slot(slot, subscribers_by_tz().get(tz, []), now)
+        if messages is None:
+            print(f"Pre-generation failed: {slot} ({tz})")
+            return
+        with ready_lock:
+            for chat_id, text in messages.items():
+                ready_messages[(chat_id, key[1], slot)] = text
+    finally:
+        preparing[key].set()
+
+def take_ready(subs, date, slot):
+    with ready_lock:
+        return {sub["chat_id"]: ready_messages.pop((sub["chat_id"], date, slot), None) for sub in subs}
+
+def send_slot(slot, tz, now=None):
+    """Deliver a slot to every subscriber in a time zone; whatever isn't pre-generated is generated inline."""
+    now = now or local_now(tz)
+    date = today_key(now)
+    event = preparing.get((tz, date, slot))
+    if event:
+        event.wait(timeout=600)
+    subs = subscribers_by_tz().get(tz, [])
+    texts = take_ready(subs, date, slot)
+    missing = [sub for sub in subs if not texts[sub["chat_id"]]]
+    if missing:
+        texts.update(prepare_slot(slot, missing, now) or {})
+    safe_send_many([(sub["chat_id"], texts.get(sub["chat_id"]) or slot_fallback(slot, now)) for sub in subs])
+
+def send_slot_now(sub, slot):
+    """Manual /morning etc.: the date's shared story with a newly written personal part.
+
+    The shared story is generated only if the slot has none yet for the date.
+    """
+    now = local_now(sub["tz"])
+    messages = prepare_slot(slot, [sub], now) or {}
+    safe_send(sub["chat_id"], messages.get(sub["chat_id"]) or slot_fallback(slot, now))
+
 def send_morning():
-    date_str = today_display()
-    facts = fetch_this_day_facts()
-    used_facts_today["date"] = get_israel_now().strftime("%Y-%m-%d")
-    used_facts_today["morning"] = facts[:500]
-    prompt = f"Сегодня: {date_str}.\n\n{facts}\n\nСгенерируй УТРЕННЕЕ сообщение. Выбери самые удивительные факты. Запомни какие факты ты выбрал — днём и вечером будут ДРУГИЕ."
-    response = call_claude(MORNING_PROMPT, prompt)
-    if response:
-        used_facts_today["morning"] = response
-        safe_send(MY_CHAT_ID, response)
-    else:
-        safe_send(MY_CHAT_ID, f"☀️ {date_str}\n\nClaude думает... Но ты не думай — действуй!")
+    send_slot("morning", DEFAULT_TZ)
 
 def send_afternoon():
-    date_str = today_display()
-    facts = fetch_this_day_facts()
-    already_used = used_facts_today.get("morning", "")
-    prompt = f"Сегодня: {date_str}.\n\n{facts}\n\nВот что УЖЕ БЫЛО в утреннем сообщении (НЕ ПОВТОРЯЙ эти факты, выбери СОВЕРШЕННО ДРУГИЕ):\n---\n{already_used[:800]}\n---\n\nСгенерируй ДНЕВНОЕ сообщение с НОВЫМИ фактами."
-    response = call_claude(DAY_PROMPT, prompt)
-    if response:
-        used_facts_today["afternoon"] = response
-        safe_send(MY_CHAT_ID, response)
-    else:
-        safe_send(MY_CHAT_ID, "🍽 Сделай одну вещь которую откладывал. Прямо сейчас.")
+    send_slot("afternoon", DEFAULT_TZ)
 
 def send_evening():
-    date_str = today_display()
-    facts = fetch_this_day_facts()
-    already_morning = used_facts_today.get("morning", "")
-    already_afternoon = used_facts_today.get("afternoon", "")
-    prompt = f"Сегодня: {date_str}.\n\n{facts}\n\nВот что УЖЕ БЫЛО утром (НЕ ПОВТОРЯЙ):\n---\n{already_morning[:600]}\n---\nВот что БЫЛО днём (НЕ ПОВТОРЯЙ):\n---\n{already_afternoon[:600]}\n---\n\nСгенерируй ВЕЧЕРНЕЕ сообщение с ПОЛНОСТЬЮ НОВЫМИ фактами и историей."
-    response = call_claude(EVENING_PROMPT, prompt)
-    if response:
-        used_facts_today["evening"] = response
-        safe_send(MY_CHAT_ID, response)
-    else:
-        safe_send(MY_CHAT_ID, "🌙 Чем сегодня будешь гордиться через год? Отдыхай.")
+    send_slot("evening", DEFAULT_TZ)
 
 # ============================================================
 # COMMANDS
 # ============================================================
+START_TEXT = (
+    "🔥 Мотиватор на связи!\n\n"
+    "Три сообщения в день с реальными фактами из истории:\n\n"
+    "☀️ 07:00 — Заряд (факты дня + цитата + пинок)\n"
+    "🍽 13:00 — Перезарядка (бизнес-совет + стартап + юмор)\n"
+    "🌙 21:00 — Рефлексия (история преодоления + вопрос)\n\n"
+    "/morning /afternoon /evening — вызвать вручную\n"
+    "/motivate — мотивация сейчас\n"
+    "/fact — 5 фактов про сегодняшний день\n"
+    "/profile — твой профиль, /tz — часовой пояс\n\n"
+    "Или просто напиши — отвечу как коуч."
+)
+JOIN_TEXT = "Подключиться: /join код-приглашения"
+SLOT_ACKS = {"morning": "☀️ Секунду...", "afternoon": "🍽 Секунду...", "evening": "🌙 Секунду..."}
+ACCOUNT_COMMANDS = ["join", "profile", "tz", "stop"]
+
+def motivate_prompt():
+    return "Один удивительный факт из списка + связь с жизнью предпринимателя. 5-7 предложений. Мощно и коротко."
+
+def fact_prompt():
+    return (
+        "Выбери 5 самых УДИВИТЕЛЬНЫХ и малоизвестных фактов. "
+        "Каждый в 2-3 предложениях с деталями. Пронумеруй."
+    )
+
 @bot.message_handler(commands=["start"])
+@traced("start")
 def cmd_start(message):
-    if message.chat.id != MY_CHAT_ID:
-        return
-    safe_send(MY_CHAT_ID,
-        "🔥 Мотиватор на связи!\n\n"
-        "Три сообщения в день с реальными фактами из истории:\n\n"
-        "☀️ 07:00 — Заряд (факты дня + цитата + пинок)\n"
-        "🍽 13:00 — Перезарядка (бизнес-совет + стартап + юмор)\n"
-        "🌙 21:00 — Рефлексия (история преодоления + вопрос)\n\n"
-        "/morning /afternoon /evening — вызвать вручную\n"
-        "/motivate — мотивация сейчас\n"
-        "/fact — 5 фактов про сегодняшний день\n\n"
-        "Или просто напиши — отвечу как коуч."
-    )
+    sub = get_subscriber(message.chat.id)
+    if sub:
+        safe_send(sub["chat_id"], START_TEXT)
+    elif INVITE_CODE:
+        safe_send(message.chat.id, JOIN_TEXT)
+
+@bot.message_handler(commands=ACCOUNT_COMMANDS)
+@traced("account")
+def cmd_account(message):
+    reply = account_command(message)
+    if reply:
+        safe_send(message.chat.id, reply)
 
 @bot.message_handler(commands=["morning"])
+@traced("morning")
 def cmd_morning(message):
-    if message.chat.id != MY_CHAT_ID: return
-    safe_send(MY_CHAT_ID, "☀️ Секунду...")
-    send_morning()
+    sub = get_subscriber(message.chat.id)
+    if not sub: return
+    safe_send(sub["chat_id"], SLOT_ACKS["morning"])
+    send_slot_now(sub, "morning")
 
 @bot.message_handler(commands=["afternoon"])
+@traced("afternoon")
 def cmd_afternoon(message):
-    if message.chat.id != MY_CHAT_ID: return
-    safe_send(MY_CHAT_ID, "🍽 Секунду...")
-    send_afternoon()
+    sub = get_subscriber(message.chat.id)
+    if not sub: return
+    safe_send(sub["chat_id"], SLOT_ACKS["afternoon"])
+    send_slot_now(sub, "afternoon")
 
 @bot.message_handler(commands=["evening"])
+@traced("evening")
 def cmd_evening(message):
-    if message.chat.id != MY_CHAT_ID: return
-    safe_send(MY_CHAT_ID, "🌙 Секунду...")
-    send_evening()
+    sub = get_subscriber(message.chat.id)
+    if not sub: return
+    safe_send(sub["chat_id"], SLOT_ACKS["evening"])
+    send_slot_now(sub, "evening")
 
 @bot.message_handler(commands=["motivate"])
+@traced("motivate")
 def cmd_motivate(message):
-    if message.chat.id != MY_CHAT_ID: return
-    facts = fetch_this_day_facts()
-    prompt = f"Сегодня: {today_display()}.\n\n{facts}\n\nОдин удивительный факт из списка + связь с жизнью предпринимателя. 5-7 предложений. Мощно и коротко."
-    response = call_claude(BASE_PROMPT, prompt)
-    if response:
-        safe_send(MY_CHAT_ID, response)
+    sub = get_subscriber(message.chat.id)
+    if not sub: return
+    facts = fetch_this_day_facts(local_now(sub["tz"]))
+    response = reply_claude(sub["chat_id"], base_prompt_for(sub), motivate_prompt(), facts=facts)
+    mark_facts_used(facts, response, "motivate")
 
 @bot.message_handler(commands=["fact"])
+@traced("fact")
 def cmd_fact(message):
-    if message.chat.id != MY_CHAT_ID: return
-    safe_send(MY_CHAT_ID, "🔍 Ищу факты...")
-    facts = fetch_this_day_facts()
-    prompt = (
-        f"Сегодня: {today_display()}.\n\n{facts}\n\n"
-        "Выбери 5 самых УДИВИТЕЛЬНЫХ и малоизвестных фактов. "
-        "Каждый в 2-3 предложениях с деталями. Пронумеруй."
-    )
-    response = call_claude(BASE_PROMPT, prompt)
-    if response:
-        safe_send(MY_CHAT_ID, response)
+    sub = get_subscriber(message.chat.id)
+    if not sub: return
+    safe_send(sub["chat_id"], "🔍 Ищу факты...")
+    facts = fetch_this_day_facts(local_now(sub["tz"]))
+    response = reply_claude(sub["chat_id"], base_prompt_for(sub), fact_prompt(), facts=facts)
+    mark_facts_used(facts, response, "fact")
 
 # ============================================================
 # FREE TEXT — Coach
 # ============================================================
-COACH_PROMPT = """Ты — мотивационный коуч Михаила Соломоновича (предприниматель, Израиль, клиника красоты iStudio, проект GlowNow).
+def coach_prompt(user_text, sub):
+    now = local_now(sub["tz"])
+    time_ctx = "утро" if now.hour < 12 else "день" if now.hour < 18 else "вечер"
+    name = "Соломонович" if sub["chat_id"] == MY_CHAT_ID else sub["name"]
+    return f"Сейчас {time_ctx} ({now.strftime('%H:%M')}).\n\nВыбери один факт из списка. Если подходящих не осталось — расскажи малоизвестный факт из своих знаний про этот день в истории.\n\n{name} написал: «{user_text}»"
 
-ПРАВИЛО: В КАЖДОМ ответе — ОБЯЗАТЕЛЬНО один малоизвестный исторический факт, который произошёл ИМЕННО В ЭТОТ ДЕНЬ в истории. Факт должен быть удивительным и неожиданным. Из этого факта выведи совет или поддержку для Соломоновича.
+@bot.message_handler(func=lambda m: get_subscriber(m.chat.id) is not None)
+@traced("chat")
+def handle_text(message):
+    sub = get_subscriber(message.chat.id)
+    facts = fetch_this_day_facts(local_now(sub["tz"]))
+    response = reply_claude(sub["chat_id"], coach_prompt_for(sub), coach_prompt(message.text.strip(), sub),
+                            max_tokens=1500, facts=facts)
+    mark_facts_used(facts, response, "chat")
 
-Структура ответа:
-1. Ответ на его вопрос/реплику (2-3 предложения)
-2. Исторический факт этого дня (3-5 предложений с деталями: имена, даты, цифры)
-3. Связь факта с его ситуацией — совет или поддержка (2-3 предложения)
+# ============================================================
+# WEBHOOK
+# ============================================================
+# Telegram retries a webhook until it gets a 2xx, and every replica on the
+# host may see the same update, so each update_id is claimed in the SQLite
+# database they share before it's handled and is acknowledged at once.
+with db_lock:
+    db.execute("CREATE TABLE IF NOT EXISTS seen_updates (update_id INTEGER PRIMARY KEY, seen_at REAL NOT NULL)")
+    db.commit()
 
-НЕ используй звёздочки, подчёркивания или Markdown — ТОЛЬКО чистый текст и эмодзи.
-Обращайся: Соломонович, Дорогой, Дружище или Михаил Соломонович.
+def claim_update(update_id):
+    """True the first time an update_id is seen by any replica sharing FACTS_DB."""
+    now = time.time()
+    with db_lock:
+        claimed = db.execute("INSERT OR IGNORE INTO seen_updates (update_id, seen_at) VALUES (?, ?)",
+                             (update_id, now)).rowcount == 1
+        if update_id % 100 == 0:
+            db.execute("DELETE FROM seen_updates WHERE seen_at < ?", (now - 86400,))
+        db.commit()
+    return claimed
+
+def secret_ok(headers):
+    return hmac.compare_digest(headers.get("X-Telegram-Bot-Api-Secret-Token", ""), WEBHOOK_SECRET)
+
+def update_chat_id(data):
+    for key in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        if key in data:
+            return data[key].get("chat", {}).get("id", 0)
+    if "callback_query" in data:
+        return data["callback_query"].get("message", {}).get("chat", {}).get("id", 0)
+    return 0
+
+def accept_update(body):
+    """Parse and dedupe a webhook body; returns the update dict to handle or None."""
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return None
+    if "update_id" not in data or not claim_update(data["update_id"]):
+        return None
+    return data
+
+# Updates of one chat always land on the same worker, so they're handled in order
+update_queues = [queue.Queue(maxsize=1000) for _ in range(WEBHOOK_WORKERS)]
+
+def update_worker(q):
+    while True:
+        data = q.get()
+        try:
+            bot.process_new_updates([telebot.types.Update.de_json(data)])
+        except Exception as e:
+            print(f"Update error: {e}")
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def do_POST(self):
+        if self.path != WEBHOOK_PATH or not secret_ok(self.headers):
+            self.send_response(403)
+            self.end_headers()
+            return
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(200)
+        self.end_headers()
+        data = accept_update(body)
+        if data is None:
+            return
+        try:
+            update_queues[update_chat_id(data) % WEBHOOK_WORKERS].put_nowait(data)
+        except queue.Full:
+            print(f"Update queue full, update {data['update_id']} dropped")
+
+    def log_message(self, format, *args):
+        pass
+
+def check_webhook_config():
+    if not WEBHOOK_URL or not WEBHOOK_SECRET:
+        raise SystemExit("UPDATES=webhook needs WEBHOOK_URL and WEBHOOK_SECRET")
+
+def run_webhook_server():
+    check_webhook_config()
+    # Handlers run on our per-chat workers, not on TeleBot's own pool
+    bot.threaded = False
+    for q in update_queues:
+        threading.Thread(target=update_worker, args=(q,), daemon=True).start()
+    bot.set_webhook(url=WEBHOOK_URL + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+    print(f"🌐 Webhook on :{PORT}{WEBHOOK_PATH}")
+    ThreadingHTTPServer(("0.0.0.0", PORT), WebhookHandler).serve_forever()
 
-ОБЯЗАТЕЛЬНО в каждом ответе — один конкретный совет "СДЕЛАЙ ПРЯМО СЕЙЧАС" для iStudio или GlowNow. Не общие слова, а точные шаги которые можно выполнить за 5-15 минут. С конкретными процедурами (VECTUS, BBL, MOXI, карбоновый пилинг, эндосфера) и каналами (WhatsApp, amoCRM, Instagram)."""
-@bot.message_handler(func=lambda m: m.chat.id == MY_CHAT_ID)
-def handle_text(message):
-    user_text = message.text.strip()
-    hour = get_israel_now().hour
-    time_ctx = "утро" if hour < 12 else "день" if hour < 18 else "вечер"
-    facts = fetch_this_day_facts()
-    already_used = used_facts_today.get("morning", "") + used_facts_today.get("afternoon", "") + used_facts_today.get("evening", "") + used_facts_today.get("chat", "")
-    prompt = f"Сейчас {time_ctx} ({get_israel_now().strftime('%H:%M')}). Сегодня: {today_display()}.\n\nФАКТЫ ЭТОГО ДНЯ:\n{facts}\n\nКРИТИЧЕСКИ ВАЖНО — ЭТИ ФАКТЫ УЖЕ ИСПОЛЬЗОВАНЫ СЕГОДНЯ, НЕЛЬЗЯ УПОМИНАТЬ ДАЖЕ ВСКОЛЬЗЬ:\n---\n{already_used[:1500]}\n---\nВыбери СОВЕРШЕННО ДРУГОЙ факт которого нет в списке выше. Если все факты из списка использованы — расскажи малоизвестный факт из своих знаний про этот день в истории.\n\nСоломонович написал: «{user_text}»"
-    response = call_claude(COACH_PROMPT, prompt, max_tokens=1500)
-    if response:
-        if "chat" not in used_facts_today:
-            used_facts_today["chat"] = ""
-        used_facts_today["chat"] += response[-300:] + "\n"
-        safe_send(MY_CHAT_ID, response)
 # ============================================================
 # SCHEDULER
 # ============================================================
+# Jobs sit on a heap as (when, job, slot, tz, date), with `when` computed
+# from the local wall clock of each subscriber time zone, so DST moves them
+# along with the zone. A job is recorded in SQLite once it has done its work
+# (for a send: once the messages are in the outbox) and is held in
+# running_jobs until then; after a restart, whatever was missed less than
+# CATCHUP_GRACE_MINUTES ago still runs.
+with db_lock:
+    db.execute("""CREATE TABLE IF NOT EXISTS fired_jobs (
+        tz TEXT NOT NULL,
+        date TEXT NOT NULL,
+        slot TEXT NOT NULL,
+        job TEXT NOT NULL,
+        fired_at REAL NOT NULL,
+        PRIMARY KEY (tz, date, slot, job))""")
+    db.commit()
+
+MAINTENANCE_INTERVAL = 3600
+# Longest the scheduler sleeps without looking at the subscriber list again
+MAX_SLEEP_SECONDS = 3600
+scheduler_wakeup = threading.Event()
+# (tz, date, slot, job) claimed by due_jobs and not finished yet
+running_jobs = set()
+running_jobs_lock = threading.Lock()
+
+def wake_scheduler():
+    """Subscriber time zones changed: rebuild the job heap right away."""
+    scheduler_wakeup.set()
+    if "wakeup" in async_state:
+        async_state["loop"].call_soon_threadsafe(async_state["wakeup"].set)
+
+def job_times(tz, day):
+    """(when, job, slot) for one local calendar day, as UTC timestamps."""
+    zone = ZoneInfo(tz)
+    times = []
+    for slot, hour in SLOT_HOURS.items():
+        deadline = datetime(day.year, day.month, day.day, hour, tzinfo=zone).timestamp()
+        times.append((deadline - SLOT_LEAD_MINUTES[slot] * 60, "pregenerate", slot))
+        times.append((deadline, "send", slot))
+    return times
+
+def fired_jobs(since):
+    with db_lock:
+        rows = db.execute("SELECT tz, date, slot, job FROM fired_jobs WHERE fired_at >= ?", (since,)).fetchall()
+    return set(rows)
+
+def mark_fired(tz, date, slot, job):
+    with db_lock:
+        db.execute("INSERT OR IGNORE INTO fired_jobs (tz, date, slot, job, fired_at) VALUES (?, ?, ?, ?, ?)",
+                   (tz, date, slot, job, time.time()))
+        db.execute("DELETE FROM fired_jobs WHERE fired_at < ?", (time.time() - 3 * 86400,))
+        db.commit()
+
+def job_heap(now):
+    """Jobs that haven't run yet: missed ones within the grace window and everything ahead.
+
+    Yesterday is included so a long grace window can still catch up its last slot.
+    """
+    done = fired_jobs(now - 3 * 86400)
+    grace_start = now - CATCHUP_GRACE_MINUTES * 60
+    heap = []
+    for tz in subscribers_by_tz():
+        today = datetime.fromtimestamp(now, ZoneInfo(tz)).date()
+        for day in (today - timedelta(days=1), today, today + timedelta(days=1)):
+            date = day.isoformat()
+            times = job_times(tz, day)
+            sends = {slot: when for when, job, slot in times if job == "send"}
+            for when, job, slot in times:
+                if when < grace_start or (tz, date, slot, job) in done:
+                    continue
+                # Too late to prepare ahead; the send generates on its own
+                if job == "pregenerate" and sends[slot] <= now:
+                    continue
+                heapq.heappush(heap, (when, job, slot, tz, date))
+    return heap
+
+def due_jobs(now=None):
+    """Claim every job whose time has come and that isn't already running.
+
+    Returns the (when, job, slot, tz, date) to run now and the seconds until
+    the next deadline.
+    """
+    now = now or time.time()
+    heap = job_heap(now)
+    jobs = []
+    while heap and heap[0][0] <= now:
+        when, job, slot, tz, date = heapq.heappop(heap)
+        with running_jobs_lock:
+            if (tz, date, slot, job) in running_jobs:
+                continue
+            running_jobs.add((tz, date, slot, job))
+        if now - when > 60:
+            print(f"⏪ Catching up {job} {slot} for {tz} ({date}), {int(now - when) // 60} min late")
+        jobs.append((when, job, slot, tz, date))
+    oldest = today_key(get_israel_now() - timedelta(days=2))
+    for key in [k for k in preparing if k[1] < oldest]:
+        del preparing[key]
+    return jobs, (heap[0][0] - now if heap else MAX_SLEEP_SECONDS)
+
+def job_done(job, slot, tz, date, ok):
+    """Release a claimed job; a finished one is recorded so it never runs again."""
+    if ok:
+        mark_fired(tz, date, slot, job)
+    with running_jobs_lock:
+        running_jobs.discard((tz, date, slot, job))
+
+def run_job(when, job, slot, tz, date):
+    ok = False
+    try:
+        with trace(f"{job}_{slot}", tz=tz):
+            if job == "pregenerate":
+                pregenerate(slot, tz)
+            else:
+                # At the slot's own time, so a late catch-up still sends that date's message
+                send_slot(slot, tz, datetime.fromtimestamp(when, ZoneInfo(tz)))
+        ok = True
+    finally:
+        job_done(job, slot, tz, date, ok)
+
 def run_scheduler():
-    schedule.every().day.at(f"{7 - ISRAEL_UTC_OFFSET:02d}:00").do(send_morning)
-    schedule.every().day.at(f"{13 - ISRAEL_UTC_OFFSET:02d}:00").do(send_afternoon)
-    schedule.every().day.at(f"{21 - ISRAEL_UTC_OFFSET:02d}:00").do(send_evening)
-    print("📋 07:00 | 13:00 | 21:00 (Israel)")
+    print("📋 07:00 | 13:00 | 21:00 (local time of each subscriber)")
+    # The facts cache was just warmed at startup
+    next_maintenance = time.time() + MAINTENANCE_INTERVAL
+    while True:
+        if time.time() >= next_maintenance:
+            warm_facts_cache()
+            threading.Thread(target=refresh_stale_days, daemon=True).start()
+            next_maintenance = time.time() + MAINTENANCE_INTERVAL
+        scheduler_wakeup.clear()
+        jobs, wait = due_jobs()
+        for job in jobs:
+            threading.Thread(target=run_job, args=job, daemon=True).start()
+        scheduler_wakeup.wait(min(wait, MAX_SLEEP_SECONDS, max(0, next_maintenance - time.time())))
+
+# ============================================================
+# ASYNC ENGINE (RUNTIME=async)
+# ============================================================
+# One event loop runs polling, the scheduler, Wikipedia and Claude I/O.
+# Updates are queued per chat so each chat is answered strictly in order,
+# and CLAUDE_CONCURRENCY caps Claude requests in flight across all chats.
+async_state = {}
+
+def async_claude_slots():
+    if "claude_slots" not in async_state:
+        async_state["claude_slots"] = asyncio.Semaphore(CLAUDE_CONCURRENCY)
+    return async_state["claude_slots"]
+
+async def afetch_onthisday(session, kind, month, day):
+    url = f"{WIKI_FEED_URL}/{kind}/{month:02d}/{day:02d}"
+    async with session.get(url, timeout=aiohttp.ClientTimeout(total=15)) as resp:
+        resp.raise_for_status()
+        data = await resp.json()
+    return parse_feed(kind, data)
+
+async def arefresh_day(month, day):
+    kinds = ("events", "births")
+    results = await asyncio.gather(
+        *(afetch_onthisday(async_state["http"], kind, month, day) for kind in kinds),
+        return_exceptions=True)
+    feeds = {}
+    for kind, result in zip(kinds, results):
+        if isinstance(result, Exception):
+            print(f"Wikipedia {kind} error: {result}")
+            feeds[kind] = None
+        else:
+            feeds[kind] = result
+    return store_day(month, day, feeds)
+
+def arefresh_day_background(month, day):
+    with facts_cache_lock:
+        if (month, day) in facts_refreshing:
+            return
+        facts_refreshing.add((month, day))
+
+    async def run():
+        try:
+            await arefresh_day(month, day)
+        finally:
+            with facts_cache_lock:
+                facts_refreshing.discard((month, day))
+
+    spawn(run())
+
+async def afetch_this_day_facts(now=None):
+    now = now or get_israel_now()
+    with stage("facts"):
+        entry = cached_day(now.month, now.day)
+        if entry is None:
+            entry = await arefresh_day(now.month, now.day)
+        return day_facts_block(now, entry)
+
+def awarm_facts_cache():
+    now = get_israel_now()
+    for d in (now - timedelta(days=1), now, now + timedelta(days=1)):
+        if cached_day(d.month, d.day) is None:
+            arefresh_day_background(d.month, d.day)
+    for month, day in stale_days(CORPUS_REFRESH_PER_HOUR):
+        arefresh_day_background(month, day)
+
+async def acall_claude(system_prompt, user_content, max_tokens=4000, retries=5, facts=None, budget="slot",
+                       deadline=None):
+    deadline = deadline or claude_deadline(budget)
+    with stage("claude"):
+        for attempt in range(retries):
+            if deadline - time.monotonic() <= 0 or claude_unavailable():
+                return None
+            model = claude_model(deadline, budget)
+            try:
+                async with async_claude_slots():
+                    response = await async_state["claude"].messages.create(
+                        **claude_request(system_prompt, user_content, max_tokens, facts, model),
+                        timeout=max(1.0, deadline - time.monotonic()))
+            except Exception as e:
+                delay = claude_failure(e, attempt, retries, deadline, model)
+                if delay is None:
+                    return None
+                await asyncio.sleep(delay)
+                continue
+            claude_breaker.success()
+            record_usage(response.usage)
+            return response.content[0].text
+    return None
+
+async def asafe_send(chat_id, text, max_len=4000):
+    safe_send(chat_id, text, max_len)
+
+async def adeliver(chat_id, part):
+    with stage("telegram"):
+        try:
+            await async_state["bot"].send_message(chat_id, part[1])
+        except Exception as e:
+            delivery_failed(chat_id, part, e)
+            return
+    delivered(chat_id, part)
+
+async def arun_outbox():
+    wakeup = async_state["outbox_wakeup"] = asyncio.Event()
     while True:
-        schedule.run_pending()
-        time.sleep(30)
+        wakeup.clear()
+        lease_check = outbox.keep_lease()
+        item, wait = outbox.take()
+        if item:
+            spawn(adeliver(*item))
+            continue
+        try:
+            await asyncio.wait_for(wakeup.wait(), lease_check if wait is None else min(wait, lease_check))
+        except asyncio.TimeoutError:
+            pass
+
+async def aacquire(chat_id):
+    while True:
+        delay = outbox.reserve(chat_id)
+        if not delay:
+            return
+        await asyncio.sleep(delay)
+
+async def asafe_edit(chat_id, message_id, text):
+    try:
+        await async_state["bot"].edit_message_text(text, chat_id, message_id)
+    except Exception as e:
+        retry_after(e)
+        if "message is not modified" not in str(e):
+            print(f"Edit error: {e}")
+            return False
+    return True
 
-if __name__ == "__main__":
+async def apaced_call(chat_id, deadline, call):
+    attempt = 0
+    while True:
+        await aacquire(chat_id)
+        try:
+            return await call()
+        except Exception as e:
+            if "message is not modified" in str(e):
+                return None
+            action, delay = send_failure(e, attempt)
+            if action != "retry" or time.monotonic() + delay >= deadline:
+                raise
+            print(f"Telegram error (retry in {delay:.0f}s): {e}")
+            await asyncio.sleep(delay)
+            attempt += 1
+
+async def astream_send(chat_id, text, deadline):
+    try:
+        message = await apaced_call(chat_id, deadline, lambda: async_state["bot"].send_message(chat_id, text))
+    except Exception:
+        sent_message(False)
+        raise
+    sent_message(True)
+    return message.message_id
+
+async def astream_edit(chat_id, message_id, text, deadline):
+    await apaced_call(chat_id, deadline, lambda: async_state["bot"].edit_message_text(text, chat_id, message_id))
+
+async def astream_claude(chat_id, system_prompt, user_content, max_tokens=4000, max_len=4000, facts=None,
+                         deadline=None):
+    abot = async_state["bot"]
+    deadline = deadline or claude_deadline("chat")
+    if claude_unavailable():
+        return None
+    waited = time.monotonic()
+    while outbox.pending(chat_id) and time.monotonic() - waited < 10:
+        await asyncio.sleep(0.05)
+    try:
+        message_id = await astream_send(chat_id, "✍️ ...", deadline)
+    except Exception as e:
+        print(f"Send error: {e}")
+        return None
+    buf = StreamBuffer(max_len)
+    broken = False
+    async with async_claude_slots():
+        try:
+            async with async_state["claude"].messages.stream(
+                    **claude_request(system_prompt, user_content, max_tokens, facts),
+                    timeout=max(1.0, deadline - time.monotonic())) as stream:
+                async for chunk in stream.text_stream:
+                    for op, text in buf.feed(chunk):
+                        if op == "new":
+                            message_id = await astream_send(chat_id, text, deadline)
+                        elif op == "edit":
+                            await astream_edit(chat_id, message_id, text, deadline)
+                        elif outbox.reserve(chat_id) or not await asafe_edit(chat_id, message_id, text):
+                            buf.skip()
+                record_usage((await stream.get_final_message()).usage)
+            claude_breaker.success()
+        except Exception as e:
+            if retryable(e):
+                claude_breaker.failure()
+            print(f"Claude stream error: {e}")
+            if not buf.full:
+                try:
+                    await abot.delete_message(chat_id, message_id)
+                except Exception:
+                    pass
+                return None
+            broken = True
+    try:
+        for op, text in buf.finish():
+            await astream_edit(chat_id, message_id, text, deadline)
+    except Exception as e:
+        print(f"Edit error: {e}")
+        broken = True
+    if broken:
+        trace_add("stream_broken")
+        await asafe_send(chat_id, STREAM_BROKEN_NOTICE)
+        return ""
+    return buf.full
+
+async def areply_claude(chat_id, system_prompt, user_content, max_tokens=4000, facts=None):
+    deadline = claude_deadline("chat")
+    if STREAM_REPLIES:
+        with stage("claude_stream"):
+            response = await astream_claude(chat_id, system_prompt, user_content, max_tokens, facts=facts,
+                                            deadline=deadline)
+        if response is not None:
+            return response
+    response = await acall_claude(system_prompt, user_content, max_tokens, facts=facts, budget="chat",
+                                  deadline=deadline)
+    if response:
+        await asafe_send(chat_id, response)
+    return response
+
+async def aensure_story(slot, now):
+    async with async_state["generation_lock"]:
+        for s in stories_to_generate(slot, now):
+            facts = await afetch_this_day_facts(now)
+            system_prompt, prompt = build_slot_prompt(s)
+            story = await acall_claude(system_prompt, prompt, facts=facts)
+            store_story(s, now, story, facts)
+        return stories.get((today_key(now), slot))
+
+async def apersonalize(sub, slot, story):
+    prompt, shared = personal_request(sub, slot, story)
+    return with_personal(story, await acall_claude(personal_prompt_for(sub), prompt, max_tokens=PERSONAL_MAX_TOKENS,
+                                                   facts=shared))
+
+async def aprepare_slot(slot, subs, now):
+    story = await aensure_story(slot, now)
+    if not story:
+        return None
+    texts = await asyncio.gather(*(apersonalize(sub, slot, story) for sub in subs))
+    return {sub["chat_id"]: text for sub, text in zip(subs, texts)}
+
+async def apregenerate(slot, tz):
+    now = local_now(tz)
+    key = (tz, today_key(now), slot)
+    if key in preparing:
+        return
+    preparing[key] = asyncio.Event()
+    try:
+        messages = await aprepare_slot(slot, subscribers_by_tz().get(tz, []), now)
+        if messages is None:
+            print(f"Pre-generation failed: {slot} ({tz})")
+            return
+        for chat_id, text in messages.items():
+            ready_messages[(chat_id, key[1], slot)] = text
+    finally:
+        preparing[key].set()
+
+async def asend_slot(slot, tz, now=None):
+    now = now or local_now(tz)
+    date = today_key(now)
+    event = preparing.get((tz, date, slot))
+    if event:
+        try:
+            await asyncio.wait_for(event.wait(), timeout=600)
+        except asyncio.TimeoutError:
+            pass
+    subs = subscribers_by_tz().get(tz, [])
+    texts = take_ready(subs, date, slot)
+    missing = [sub for sub in subs if not texts[sub["chat_id"]]]
+    if missing:
+        texts.update(await aprepare_slot(slot, missing, now) or {})
+    safe_send_many([(sub["chat_id"], texts.get(sub["chat_id"]) or slot_fallback(slot, now)) for sub in subs])
+
+async def asend_slot_now(sub, slot):
+    now = local_now(sub["tz"])
+    messages = await aprepare_slot(slot, [sub], now) or {}
+    await asafe_send(sub["chat_id"], messages.get(sub["chat_id"]) or slot_fallback(slot, now))
+
+def spawn(coro):
+    """Run a coroutine as a tracked task so shutdown can cancel it."""
+    task = asyncio.get_running_loop().create_task(coro)
+    async_state["tasks"].add(task)
+    task.add_done_callback(async_state["tasks"].discard)
+    return task
+
+async def chat_worker(chat_id, queue):
+    while True:
+        try:
+            job = await asyncio.wait_for(queue.get(), timeout=CHAT_IDLE_SECONDS)
+        except asyncio.TimeoutError:
+            # Idle chats give their worker back; the next update starts a new one
+            if queue.empty():
+                async_state["chats"].pop(chat_id, None)
+                return
+            continue
+        try:
+            await job
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Handler error: {e}")
+
+def dispatch(chat_id, job):
+    """Queue a handler coroutine behind everything already queued for this chat."""
+    chats = async_state["chats"]
+    if chat_id not in chats:
+        queue = asyncio.Queue(maxsize=CHAT_QUEUE_SIZE)
+        chats[chat_id] = queue
+        spawn(chat_worker(chat_id, queue))
+    try:
+        chats[chat_id].put_nowait(job)
+    except asyncio.QueueFull:
+        job.close()
+        print(f"Chat {chat_id} queue full, update dropped")
+
+async def ahandle_slot_command(sub, slot):
+    with trace(slot, sub["chat_id"]):
+        await asafe_send(sub["chat_id"], SLOT_ACKS[slot])
+        await asend_slot_now(sub, slot)
+
+@traced("motivate")
+async def ahandle_motivate(sub):
+    facts = await afetch_this_day_facts(local_now(sub["tz"]))
+    response = await areply_claude(sub["chat_id"], base_prompt_for(sub), motivate_prompt(), facts=facts)
+    mark_facts_used(facts, response, "motivate")
+
+@traced("fact")
+async def ahandle_fact(sub):
+    await asafe_send(sub["chat_id"], "🔍 Ищу факты...")
+    facts = await afetch_this_day_facts(local_now(sub["tz"]))
+    response = await areply_claude(sub["chat_id"], base_prompt_for(sub), fact_prompt(), facts=facts)
+    mark_facts_used(facts, response, "fact")
+
+@traced("chat")
+async def ahandle_text(sub, user_text):
+    facts = await afetch_this_day_facts(local_now(sub["tz"]))
+    response = await areply_claude(sub["chat_id"], coach_prompt_for(sub), coach_prompt(user_text, sub),
+                                   max_tokens=1500, facts=facts)
+    mark_facts_used(facts, response, "chat")
+
+def register_async_handlers(abot):
+    @abot.message_handler(func=lambda m: True)
+    async def on_message(message):
+        text = (message.text or "").strip()
+        command = text.split()[0].split("@")[0] if text.startswith("/") else ""
+        sub = get_subscriber(message.chat.id)
+        if command[1:] in ACCOUNT_COMMANDS:
+            reply = account_command(message)
+            job = asafe_send(message.chat.id, reply) if reply else None
+        elif command == "/start":
+            job = asafe_send(message.chat.id, START_TEXT if sub else JOIN_TEXT) if sub or INVITE_CODE else None
+        elif not sub:
+            job = None
+        elif command[1:] in SLOT_ACKS:
+            job = ahandle_slot_command(sub, command[1:])
+        elif command == "/motivate":
+            job = ahandle_motivate(sub)
+        elif command == "/fact":
+            job = ahandle_fact(sub)
+        elif text:
+            job = ahandle_text(sub, text)
+        else:
+            job = None
+        if job:
+            dispatch(message.chat.id, job)
+
+async def aupdate_consumer():
+    """Feed webhook updates to the bot one at a time; handlers only enqueue per-chat work, so this stays fast."""
+    from telebot.types import Update
+    updates = async_state["updates"]
+    while True:
+        data = await updates.get()
+        try:
+            await async_state["bot"].process_new_updates([Update.de_json(data)])
+        except Exception as e:
+            print(f"Update error: {e}")
+
+async def awebhook(request):
+    if not secret_ok(request.headers):
+        return aiohttp.web.Response(status=403)
+    data = accept_update(await request.read())
+    if data is not None:
+        try:
+            async_state["updates"].put_nowait(data)
+        except asyncio.QueueFull:
+            print(f"Update queue full, update {data['update_id']} dropped")
+    return aiohttp.web.Response(text="ok")
+
+async def astart_webhook_server():
+    check_webhook_config()
+    app = aiohttp.web.Application()
+    app.router.add_post(WEBHOOK_PATH, awebhook)
+    app.router.add_get("/", lambda request: aiohttp.web.Response(text="ok"))
+    runner = aiohttp.web.AppRunner(app)
+    await runner.setup()
+    await aiohttp.web.TCPSite(runner, "0.0.0.0", PORT).start()
+    async_state["runner"] = runner
+    async_state["updates"] = asyncio.Queue(maxsize=1000)
+    spawn(aupdate_consumer())
+    await async_state["bot"].set_webhook(url=WEBHOOK_URL + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+    print(f"🌐 Webhook on :{PORT}{WEBHOOK_PATH} (async)")
+
+async def arun_job(when, job, slot, tz, date):
+    ok = False
+    try:
+        with trace(f"{job}_{slot}", tz=tz):
+            if job == "pregenerate":
+                await apregenerate(slot, tz)
+            else:
+                await asend_slot(slot, tz, datetime.fromtimestamp(when, ZoneInfo(tz)))
+        ok = True
+    finally:
+        job_done(job, slot, tz, date, ok)
+
+async def arun_scheduler():
+    print("📋 07:00 | 13:00 | 21:00 (local time of each subscriber)")
+    wakeup = async_state["wakeup"] = asyncio.Event()
+    next_maintenance = 0.0
+    while True:
+        if time.time() >= next_maintenance:
+            awarm_facts_cache()
+            next_maintenance = time.time() + MAINTENANCE_INTERVAL
+        wakeup.clear()
+        jobs, wait = due_jobs()
+        for job in jobs:
+            spawn(arun_job(*job))
+        try:
+            await asyncio.wait_for(wakeup.wait(), min(wait, MAX_SLEEP_SECONDS, max(0, next_maintenance - time.time())))
+        except asyncio.TimeoutError:
+            pass
+
+async def amain():
+    from telebot.async_telebot import AsyncTeleBot
+    abot = AsyncTeleBot(TELEGRAM_TOKEN)
+    async_state.update({
+        "loop": asyncio.get_running_loop(),
+        "bot": abot,
+        "claude": anthropic.AsyncAnthropic(api_key=ANTHROPIC_KEY, max_retries=0),
+        "http": aiohttp.ClientSession(headers={"User-Agent": "MotivatorBot/1.0"}),
+        "generation_lock": asyncio.Lock(),
+        "tasks": set(),
+        "chats": {},
+    })
+    register_async_handlers(abot)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        spawn(arun_outbox())
+        if RUN_SCHEDULER:
+            spawn(arun_scheduler())
+        if UPDATES == "webhook":
+            await astart_webhook_server()
+        else:
+            await abot.delete_webhook(drop_pending_updates=True)
+            spawn(abot.infinity_polling(timeout=60))
+            print("📱 Polling (async)...")
+        await stop.wait()
+    finally:
+        print("🛑 Shutting down...")
+        tasks = list(async_state["tasks"])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if "runner" in async_state:
+            await async_state["runner"].cleanup()
+        await abot.close_session()
+        await async_state["claude"].close()
+        await async_state["http"].close()
+
+if __name__ == "__main__" and sys.argv[1:2] == ["build-corpus"]:
+    # python agent.py build-corpus [--from DIR] [--force]
+    args = sys.argv[2:]
+    build_corpus(args[args.index("--from") + 1] if "--from" in args else None, force="--force" in args)
+elif __name__ == "__main__" and sys.argv[1:2] == ["refresh-corpus"]:
+    refresh_stale_days(limit=366)
+elif __name__ == "__main__":
     print("🔥 МОТИВАТОР НА ПОСТУ!")
     print(f"📅 {get_israel_now().strftime('%Y-%m-%d %H:%M')}")
-    bot.delete_webhook(drop_pending_updates=True)
-    time.sleep(1)
-    threading.Thread(target=run_scheduler, daemon=True).start()
-    print("📱 Polling...")
-    bot.infinity_polling(timeout=60, long_polling_timeout=60)
+    ensure_owner()
+    start_metrics_server()
+    if RUNTIME == "async":
+        asyncio.run(amain())
+    else:
+        start_outbox()
+        warm_facts_cache()
+        if RUN_SCHEDULER:
+            threading.Thread(target=run_scheduler, daemon=True).start()
+        if UPDATES == "webhook":
+            run_webhook_server()
+        else:
+            bot.delete_webhook(drop_pending_updates=True)
+            time.sleep(1)
+            print("📱 Polling...")
+            bot.infinity_polling(timeout=60, long_polling_timeout=60)
@@ -0,0 +1,377 @@
+"""End-to-end benchmark of the bot against local stand-ins for Wikipedia, Anthropic and Telegram.
+
+    python bench.py                    # run and compare with bench_baseline.json
+    python bench.py --save-baseline    # run and store the result as the new baseline
+    python bench.py --claude-latency 2 --overload-rate 0.1 --subscribers 50
+
+The fake services run in a child process, so peak RSS and thread counts
+are the bot's own. The bot talks to them through WIKI_FEED_URL,
+ANTHROPIC_BASE_URL and telebot's API_URL; its own log goes to
+bench_output.txt. Exits with 1 when a metric regressed past --tolerance.
+"""
+import os
+import sys
+import json
+import re
+import time
+import random
+import argparse
+import resource
+import tempfile
+import threading
+import multiprocessing
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+# ============================================================
+# FAKE SERVICES
+# ============================================================
+SENTENCES = [
+    "Каждый большой бизнес когда-то был маленькой идеей, которую кто-то не бросил.",
+    "Сегодня — хороший день, чтобы сделать один звонок, который ты откладывал.",
+    "Клиенты не покупают процедуры, они покупают уверенность в себе.",
+    "Дисциплина — это мост между целями и результатом.",
+    "Маленький шаг каждый день обгоняет рывок раз в месяц.",
+    "Ошибки — это плата за опыт, и ты её уже внёс.",
+]
+WIKI_WORDS = ("company founded invented first record war treaty king city river empire "
+              "business launched space nobel scientist engineer author church battle").split()
+
+def fake_feed(kind, month, day, size):
+    rnd = random.Random(f"{kind}{month}{day}")
+    return {kind: [{"year": rnd.randint(1500, 2020),
+                    "text": " ".join(rnd.choice(WIKI_WORDS) for _ in range(14)).capitalize()}
+                   for _ in range(size)]}
+
+def fake_reply(request_text, chars):
+    """Russian filler with paragraphs, mentioning the first offered fact's year so it's marked as used."""
+    year = re.search(r"\[(-?\d+)\]", request_text)
+    parts = [f"В {year.group(1)} году случилось важное." if year else "Привет!"]
+    rnd = random.Random(len(request_text))
+    while sum(len(p) for p in parts) < chars:
+        parts.append(" ".join(rnd.choice(SENTENCES) for _ in range(4)))
+    return "\n\n".join(parts)
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def json_reply(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0) or 0))
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        config, stats = self.server.config, self.server.stats
+        if path == "/_bench/stats":
+            with self.server.lock:
+                return self.json_reply(200, stats)
+        match = re.fullmatch(r"/wiki/feed/onthisday/(events|births)/(\d\d)/(\d\d)", path)
+        if match:
+            time.sleep(config["wiki_latency"])
+            with self.server.lock:
+                stats["wiki"] += 1
+            kind, month, day = match.group(1), int(match.group(2)), int(match.group(3))
+            return self.json_reply(200, fake_feed(kind, month, day, config["wiki_items"]))
+        if path.startswith("/bot"):
+            return self.telegram(path, parse_qs(urlsplit(self.path).query))
+        self.json_reply(404, {})
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        body = self.read_body()
+        if url.path == "/v1/messages":
+            return self.anthropic(json.loads(body))
+        if url.path.startswith("/bot"):
+            params = parse_qs(url.query)
+            params.update(parse_qs(body.decode("utf-8")))
+            return self.telegram(url.path, params)
+        self.json_reply(404, {})
+
+    def telegram(self, path, params):
+        method = path.rsplit("/", 1)[-1]
+        time.sleep(self.server.config["telegram_latency"])
+        chat_id = int(params.get("chat_id", ["0"])[0])
+        with self.server.lock:
+            self.server.stats["telegram"].append([time.time(), method, chat_id])
+            self.server.message_id += 1
+            message_id = self.server.message_id
+        if method in ("sendMessage", "editMessageText"):
+            text = params.get("text", [""])[0]
+            result = {"message_id": message_id, "date": int(time.time()),
+                      "chat": {"id": chat_id, "type": "private"}, "text": text}
+        elif method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        else:
+            result = True
+        self.json_reply(200, {"ok": True, "result": result})
+
+    def anthropic(self, request):
+        config, stats = self.server.config, self.server.stats
+        request_text = json.dumps(request, ensure_ascii=False)
+        with self.server.lock:
+            stats["claude"] += 1
+            overloaded = self.server.random.random() < config["overload_rate"]
+            if overloaded:
+                stats["claude_529"] += 1
+        if overloaded:
+            time.sleep(config["claude_latency"] / 4)
+            return self.json_reply(529, {"type": "error",
+                                         "error": {"type": "overloaded_error", "message": "Overloaded"}})
+        system = "".join(block["text"] for block in request.get("system", []))
+        with self.server.lock:
+            cached = system in self.server.prompt_cache
+            self.server.prompt_cache.add(system)
+        system_tokens = len(system) // 4
+        text = fake_reply(request_text, min(config["reply_chars"], request.get("max_tokens", 4000) * 2))
+        usage = {"input_tokens": len(json.dumps(request.get("messages", []))) // 4,
+                 "cache_read_input_tokens": system_tokens if cached else 0,
+                 "cache_creation_input_tokens": 0 if cached else system_tokens,
+                 "output_tokens": len(text) // 4}
+        message = {"id": "msg_bench", "type": "message", "role": "assistant", "model": request.get("model"),
+                   "stop_reason": "end_turn", "stop_sequence": None, "usage": usage}
+        time.sleep(config["claude_latency"])
+        if not request.get("stream"):
+            time.sleep(len(text) / config["claude_chars_per_second"])
+            return self.json_reply(200, {**message, "content": [{"type": "text", "text": text}]})
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        def event(name, data):
+            self.wfile.write(f"event: {name}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        event("message_start", {"type": "message_start", "message": {
+            **message, "content": [], "stop_reason": None, "usage": {**usage, "output_tokens": 1}}})
+        event("content_block_start", {"type": "content_block_start", "index": 0,
+                                      "content_block": {"type": "text", "text": ""}})
+        step = 40
+        for i in range(0, len(text), step):
+            time.sleep(step / config["claude_chars_per_second"])
+            event("content_block_delta", {"type": "content_block_delta", "index": 0,
+                                          "delta": {"type": "text_delta", "text": text[i:i + step]}})
+        event("content_block_stop", {"type": "content_block_stop", "index": 0})
+        event("message_delta", {"type": "message_delta", "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                                "usage": {"output_tokens": usage["output_tokens"]}})
+        event("message_stop", {"type": "message_stop"})
+
+    def log_message(self, format, *args):
+        pass
+
+def serve_fakes(config, ports):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeHandler)
+    server.daemon_threads = True
+    server.config = config
+    server.stats = {"wiki": 0, "claude": 0, "claude_529": 0, "telegram": []}
+    server.lock = threading.Lock()
+    server.random = random.Random(config["seed"])
+    server.prompt_cache = set()
+    server.message_id = 0
+    ports.put(server.server_address[1])
+    server.serve_forever()
+
+def fake_stats(base_url):
+    import requests
+    return requests.get(f"{base_url}/_bench/stats", timeout=10).json()
+
+# ============================================================
+# SCENARIOS
+# ============================================================
+def percentile(samples, p):
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered) + 0.5) - 1))]
+
+def summarize(samples, wall):
+    return {"n": len(samples), "p50": percentile(samples, 50), "p95": percentile(samples, 95),
+            "p99": percentile(samples, 99), "throughput": len(samples) / wall if wall else 0.0}
+
+def message(chat_id, text):
+    from telebot.types import Message
+    return Message.de_json({"message_id": 1, "date": int(time.time()), "text": text,
+                            "chat": {"id": chat_id, "type": "private"},
+                            "from": {"id": chat_id, "is_bot": False, "first_name": "Bench"}})
+
+def add_subscribers(agent, count):
+    agent.ensure_owner()
+    with agent.db_lock:
+        agent.db.executemany(
+            "INSERT OR IGNORE INTO subscribers (chat_id, name, profile, tz, joined_at) VALUES (?, ?, ?, ?, ?)",
+            [(agent.MY_CHAT_ID + i, f"Bench {i}", "Владелица салона красоты, продвигается в Instagram",
+              agent.DEFAULT_TZ, time.time()) for i in range(1, count)])
+        agent.db.commit()
+    return [agent.MY_CHAT_ID + i for i in range(count)]
+
+def bench_morning(agent, base_url, chats, rounds):
+    """Scheduled morning fan-out, story included: latency is slot start to each subscriber's last message."""
+    samples = []
+    wall = 0.0
+    for _ in range(rounds):
+        agent.stories.clear()
+        start = time.time()
+        agent.send_morning()
+        agent.outbox.wait_delivered(timeout=600)
+        wall += time.time() - start
+        last = {}
+        for t, method, chat_id in fake_stats(base_url)["telegram"]:
+            if t >= start and method == "sendMessage" and chat_id in chats:
+                last[chat_id] = max(last.get(chat_id, 0), t)
+        samples += [t - start for t in last.values()]
+    return summarize(samples, wall)
+
+def bench_handler(agent, handler, chats, text, requests_count, concurrency):
+    """Handler calls as TeleBot's worker pool would make them; latency runs until the chat's outbox is empty."""
+    def one(i):
+        start = time.perf_counter()
+        handler(message(chats[i % len(chats)], text))
+        agent.outbox.wait_delivered(chats[i % len(chats)], timeout=120)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        samples = list(pool.map(one, range(requests_count)))
+    return summarize(samples, time.perf_counter() - start)
+
+class PeakThreads:
+    def __init__(self):
+        self.peak = threading.active_count()
+        self.running = True
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while self.running:
+            self.peak = max(self.peak, threading.active_count())
+            time.sleep(0.01)
+
+# ============================================================
+# REPORT
+# ============================================================
+LATENCY_KEYS = ("p50", "p95", "p99")
+
+def compare(result, baseline, tolerance):
+    """Lines describing each metric against the baseline, and whether anything regressed."""
+    lines, regressed = [], False
+    if baseline.get("config") != result["config"]:
+        lines.append("⚠️  baseline was recorded with a different config; numbers may not be comparable")
+    for name, current in result["scenarios"].items():
+        before = baseline.get("scenarios", {}).get(name)
+        if not before:
+            continue
+        for key in LATENCY_KEYS + ("throughput",):
+            old, new = before[key], current[key]
+            if not old:
+                continue
+            change = (new - old) / old
+            # Small absolute changes in latency are noise, not regressions
+            worse = change < -tolerance if key == "throughput" else change > tolerance and new - old > 0.05
+            regressed |= worse
+            lines.append(f"{name:10} {key:10} {old:9.3f} -> {new:9.3f} ({change:+.0%}){'  ❌ REGRESSION' if worse else ''}")
+    for key in ("peak_rss_mb", "peak_threads"):
+        old, new = baseline.get(key), result[key]
+        if old:
+            worse = (new - old) / old > tolerance
+            regressed |= worse
+            lines.append(f"{key:21} {old:9.1f} -> {new:9.1f} ({(new - old) / old:+.0%}){'  ❌ REGRESSION' if worse else ''}")
+    return lines, regressed
+
+def report(result):
+    print(f"{'scenario':10} {'n':>5} {'p50 s':>8} {'p95 s':>8} {'p99 s':>8} {'ops/s':>8}")
+    for name, s in result["scenarios"].items():
+        print(f"{name:10} {s['n']:5} {s['p50']:8.3f} {s['p95']:8.3f} {s['p99']:8.3f} {s['throughput']:8.2f}")
+    print(f"\npeak RSS {result['peak_rss_mb']:.1f} MB, peak threads {result['peak_threads']}")
+    calls = result["calls"]
+    print(f"Claude calls {calls['claude']} (529s injected {calls['claude_529']}), "
+          f"Telegram calls {calls['telegram']}, Wikipedia fetches {calls['wiki']}, "
+          f"prompt cache hit rate {result['prompt_cache_hit_rate']:.0%}")
+
+# ============================================================
+# MAIN
+# ============================================================
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--subscribers", type=int, default=20)
+    parser.add_argument("--rounds", type=int, default=2, help="scheduled morning fan-outs")
+    parser.add_argument("--requests", type=int, default=20, help="/fact and /motivate calls each")
+    parser.add_argument("--burst", type=int, default=30, help="free-text messages sent at once")
+    parser.add_argument("--concurrency", type=int, default=4, help="handler threads, like TeleBot's worker pool")
+    parser.add_argument("--claude-latency", type=float, default=0.8, help="seconds to first token")
+    parser.add_argument("--claude-chars-per-second", type=float, default=4000)
+    parser.add_argument("--reply-chars", type=int, default=2500)
+    parser.add_argument("--overload-rate", type=float, default=0.0, help="share of Claude calls answered with 529")
+    parser.add_argument("--telegram-latency", type=float, default=0.05)
+    parser.add_argument("--wiki-latency", type=float, default=0.3)
+    parser.add_argument("--wiki-items", type=int, default=150)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--baseline", default="bench_baseline.json")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative change before flagging")
+    args = parser.parse_args()
+    config = {k: v for k, v in vars(args).items() if k not in ("baseline", "save_baseline", "tolerance")}
+
+    ports = multiprocessing.Queue()
+    fakes = multiprocessing.Process(target=serve_fakes, args=(config, ports), daemon=True)
+    fakes.start()
+    base_url = f"http://127.0.0.1:{ports.get(timeout=10)}"
+
+    workdir = tempfile.mkdtemp(prefix="motivator-bench-")
+    os.environ.update({
+        "TELEGRAM_TOKEN": "1:bench", "MY_CHAT_ID": "1000", "ANTHROPIC_KEY": "bench",
+        "ANTHROPIC_BASE_URL": base_url, "WIKI_FEED_URL": f"{base_url}/wiki/feed/onthisday",
+        "FACTS_DB": os.path.join(workdir, "bench.db"), "METRICS_PORT": "0", "TRACE_LOG": "0",
+    })
+    threads = PeakThreads()
+    with open("bench_output.txt", "w") as log, contextlib.redirect_stdout(log):
+        import telebot
+        import agent
+        telebot.apihelper.API_URL = base_url + "/bot{0}/{1}"
+        chats = add_subscribers(agent, args.subscribers)
+        agent.start_outbox()
+        scenarios = {
+            "morning": bench_morning(agent, base_url, chats, args.rounds),
+            "fact": bench_handler(agent, agent.cmd_fact, chats, "/fact", args.requests, args.concurrency),
+            "motivate": bench_handler(agent, agent.cmd_motivate, chats, "/motivate", args.requests, args.concurrency),
+            "chat": bench_handler(agent, agent.handle_text, chats, "Как найти новых клиентов?", args.burst, args.burst),
+        }
+    threads.running = False
+    stats = fake_stats(base_url)
+    fakes.terminate()
+    with agent.cache_stats_lock:
+        hit_rate = agent.cache_stats["hits"] / agent.cache_stats["calls"] if agent.cache_stats["calls"] else 0.0
+    result = {
+        "config": config,
+        "scenarios": scenarios,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "peak_threads": threads.peak,
+        "prompt_cache_hit_rate": hit_rate,
+        "calls": {"claude": stats["claude"], "claude_529": stats["claude_529"],
+                  "telegram": len(stats["telegram"]), "wiki": stats["wiki"]},
+    }
+    report(result)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"\nBaseline saved to {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"\nNo baseline at {args.baseline}; run with --save-baseline to record one")
+        return 0
+    with open(args.baseline) as f:
+        lines, regressed = compare(result, json.load(f), args.tolerance)
+    print(f"\nAgainst {args.baseline}:")
+    print("\n".join(lines))
+    return 1 if regressed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,110 @@
+"""Outbox delivery with Telegram stubbed out: python -m unittest test_outbox (or pytest)."""
+import os
+import tempfile
+import threading
+import time
+import types
+import unittest
+
+DB_DIR = tempfile.mkdtemp()
+# Same settings as test_slots, so the two can share one agent import under pytest
+os.environ.update(TELEGRAM_TOKEN="1:test", ANTHROPIC_API_KEY="test", MY_CHAT_ID="100", METRICS_PORT="0",
+                  FACTS_DB=os.path.join(DB_DIR, "motivator.db"), PERSONALIZE_CONCURRENCY="3")
+
+import agent
+from telebot.apihelper import ApiTelegramException
+
+
+class FakeBot:
+    """Records what went out and when; fails a chat's next send with the error queued for it."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent = {}
+        self.times = {}
+        self.errors = {}
+        self.failed = threading.Event()
+
+    def send_message(self, chat_id, text, **kwargs):
+        time.sleep(0.01)
+        with self.lock:
+            error = self.errors.pop(chat_id, None)
+            if error:
+                self.times.setdefault("error", []).append(time.monotonic())
+                self.failed.set()
+                raise error
+            self.sent.setdefault(chat_id, []).append(text)
+            self.times.setdefault(chat_id, []).append(time.monotonic())
+        return types.SimpleNamespace(message_id=len(self.sent[chat_id]))
+
+
+def too_many_requests(retry_after):
+    return ApiTelegramException("sendMessage", None, {"error_code": 429, "description": "Too Many Requests",
+                                                      "parameters": {"retry_after": retry_after}})
+
+
+class OutboxTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        agent.start_outbox()
+
+    def setUp(self):
+        self.bot = FakeBot()
+        self.patch("bot", self.bot)
+
+    def patch(self, name, value):
+        old = getattr(agent, name)
+        setattr(agent, name, value)
+        self.addCleanup(setattr, agent, name, old)
+
+    def delivered(self):
+        self.assertTrue(agent.outbox.wait_delivered(timeout=10))
+
+    def rows(self, chat_id):
+        with agent.db_lock:
+            return agent.db.execute("SELECT part, owner FROM outbox WHERE chat_id = ? ORDER BY id",
+                                    (chat_id,)).fetchall()
+
+    def test_parts_keep_their_order_per_chat(self):
+        parts = {chat_id: [f"{chat_id}-{n}" for n in range(5)] for chat_id in (201, 202, 203)}
+        agent.outbox.put(list(parts.items()))
+        self.delivered()
+        self.assertEqual(self.bot.sent, parts)
+        for chat_id in parts:
+            self.assertEqual(self.rows(chat_id), [])
+
+    def test_429_pauses_every_chat_and_retries(self):
+        self.bot.errors[301] = too_many_requests(1)
+        agent.outbox.put([(301, ["first", "second"])])
+        self.assertTrue(self.bot.failed.wait(5))
+        agent.outbox.put([(302, ["other chat"])])
+        self.delivered()
+        self.assertEqual(self.bot.sent, {301: ["first", "second"], 302: ["other chat"]})
+        hit = self.bot.times["error"][0]
+        # Telegram asked for a second; nobody gets anything before it's up
+        self.assertGreaterEqual(min(self.bot.times[301][0], self.bot.times[302][0]) - hit, 0.95)
+
+    def test_resumes_abandoned_rows_but_not_live_ones(self):
+        now = time.time()
+        with agent.db_lock:
+            agent.db.executemany(
+                "INSERT INTO outbox (chat_id, part, created_at, owner, lease_until) VALUES (?, ?, ?, ?, ?)",
+                [(401, "left over 1", now, "crashed-run", now - 1),
+                 (401, "left over 2", now, "crashed-run", now - 1),
+                 (402, "still sending", now, "live-replica", now + 600),
+                 (403, "from before leases", now, None, 0)])
+            agent.db.commit()
+        self.addCleanup(self.forget, 402)
+        agent.outbox.claim()
+        self.delivered()
+        self.assertEqual(self.bot.sent, {401: ["left over 1", "left over 2"], 403: ["from before leases"]})
+        self.assertEqual(self.rows(402), [("still sending", "live-replica")])
+
+    def forget(self, chat_id):
+        with agent.db_lock:
+            agent.db.execute("DELETE FROM outbox WHERE chat_id = ?", (chat_id,))
+            agent.db.commit()
+
+
+if __name__ == "__main__":
+    unittest.main()
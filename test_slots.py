@@ -0,0 +1,150 @@
+"""Slot delivery with Claude and Telegram stubbed out: python -m unittest test_slots (or pytest)."""
+import os
+import tempfile
+import threading
+import time
+import types
+import unittest
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+DB_DIR = tempfile.mkdtemp()
+os.environ.update(TELEGRAM_TOKEN="1:test", ANTHROPIC_API_KEY="test", MY_CHAT_ID="100", METRICS_PORT="0",
+                  FACTS_DB=os.path.join(DB_DIR, "motivator.db"), PERSONALIZE_CONCURRENCY="3")
+
+import agent
+
+FACTS = "- [1867] Alaska is transferred from Russia to the United States."
+NOW = {"Asia/Jerusalem": datetime(2026, 10, 18, 6, 30, tzinfo=ZoneInfo("Asia/Jerusalem")),
+       "Europe/Berlin": datetime(2026, 10, 18, 6, 30, tzinfo=ZoneInfo("Europe/Berlin"))}
+
+
+class FakeMessages:
+    """Stands in for claude.messages: counts story and personal calls and how many run at once."""
+
+    def __init__(self, fail=False, delay=0.05):
+        self.fail = fail
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.stories = 0
+        self.personal = 0
+        self.active = 0
+        self.peak = 0
+        self.prompts = {}
+
+    def create(self, **kwargs):
+        personal = kwargs["system"][0]["text"].startswith(agent.PERSONAL_PROMPT)
+        with self.lock:
+            if personal:
+                self.personal += 1
+                self.prompts[kwargs["messages"][0]["content"].splitlines()[0]] = kwargs["system"][0]["text"]
+            else:
+                self.stories += 1
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        try:
+            time.sleep(self.delay)
+            if self.fail:
+                raise RuntimeError("claude is down")
+            text = f"Личная часть: {kwargs['messages'][0]['content'].splitlines()[0]}" if personal else "История дня"
+            usage = types.SimpleNamespace(input_tokens=10, output_tokens=10,
+                                          cache_read_input_tokens=0, cache_creation_input_tokens=0)
+            return types.SimpleNamespace(content=[types.SimpleNamespace(text=text)], usage=usage)
+        finally:
+            with self.lock:
+                self.active -= 1
+
+
+class FakeBot:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent = {}
+
+    def send_message(self, chat_id, text, **kwargs):
+        with self.lock:
+            self.sent.setdefault(chat_id, []).append(text)
+        return types.SimpleNamespace(message_id=len(self.sent[chat_id]))
+
+
+class SlotTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        agent.start_outbox()
+
+    def setUp(self):
+        self.messages = FakeMessages()
+        self.bot = FakeBot()
+        self.patch("claude", types.SimpleNamespace(messages=self.messages))
+        self.patch("bot", self.bot)
+        self.patch("local_now", lambda tz: NOW[tz])
+        self.patch("fetch_this_day_facts", lambda now=None: FACTS)
+        agent.stories.clear()
+        agent.ready_messages.clear()
+        agent.preparing.clear()
+        with agent.db_lock:
+            agent.db.execute("DELETE FROM subscribers")
+            agent.db.execute("DELETE FROM used_facts")
+            agent.db.commit()
+
+    def patch(self, name, value):
+        old = getattr(agent, name)
+        setattr(agent, name, value)
+        self.addCleanup(setattr, agent, name, old)
+
+    def subscribe(self, count, tz, first_id):
+        with agent.db_lock:
+            agent.db.executemany(
+                "INSERT INTO subscribers (chat_id, name, profile, tz, joined_at) VALUES (?, ?, ?, ?, ?)",
+                [(chat_id, f"Гость {chat_id}", "- Салон красоты", tz, time.time())
+                 for chat_id in range(first_id, first_id + count)])
+            agent.db.commit()
+        return list(range(first_id, first_id + count))
+
+    def send(self, slot, tz):
+        agent.send_slot(slot, tz)
+        self.assertTrue(agent.outbox.wait_delivered(timeout=10))
+
+    def test_one_story_per_date_and_slot(self):
+        israel = self.subscribe(5, "Asia/Jerusalem", 100)
+        berlin = self.subscribe(3, "Europe/Berlin", 200)
+        self.send("morning", "Asia/Jerusalem")
+        self.assertEqual(sorted(self.bot.sent), israel)
+        self.send("morning", "Europe/Berlin")
+        self.assertEqual(sorted(self.bot.sent), israel + berlin)
+        self.assertEqual(self.messages.stories, 1)
+        self.assertEqual(self.messages.personal, len(israel) + len(berlin))
+        for chat_id, texts in self.bot.sent.items():
+            self.assertEqual(texts, [f"История дня\n\nЛичная часть: ПОЛУЧАТЕЛЬ: Гость {chat_id}"])
+
+    def test_personal_calls_are_bounded(self):
+        self.subscribe(10, "Asia/Jerusalem", 100)
+        self.send("morning", "Asia/Jerusalem")
+        self.assertEqual(self.messages.personal, 10)
+        self.assertEqual(self.messages.peak, agent.PERSONALIZE_CONCURRENCY)
+
+    def test_story_failure_sends_fallback(self):
+        self.messages.fail = True
+        chats = self.subscribe(3, "Asia/Jerusalem", 100)
+        self.send("afternoon", "Asia/Jerusalem")
+        self.assertEqual(self.messages.personal, 0)
+        fallback = agent.slot_fallback("afternoon", NOW["Asia/Jerusalem"])
+        self.assertEqual(self.bot.sent, {chat_id: [fallback] for chat_id in chats})
+
+    def test_owner_gets_own_personal_prompt(self):
+        self.subscribe(2, "Asia/Jerusalem", 100)
+        self.send("evening", "Asia/Jerusalem")
+        self.assertEqual(self.messages.prompts["ПОЛУЧАТЕЛЬ: Гость 100"], agent.OWNER_PERSONAL_PROMPT)
+        self.assertEqual(self.messages.prompts["ПОЛУЧАТЕЛЬ: Гость 101"], agent.GUEST_PERSONAL_PROMPT)
+
+    def test_manual_command_reuses_story(self):
+        israel = self.subscribe(2, "Asia/Jerusalem", 100)
+        self.send("morning", "Asia/Jerusalem")
+        agent.send_slot_now(agent.get_subscriber(israel[0]), "morning")
+        self.assertTrue(agent.outbox.wait_delivered(timeout=10))
+        self.assertEqual(self.messages.stories, 1)
+        self.assertEqual(self.messages.personal, 3)
+        self.assertEqual(len(self.bot.sent[israel[0]]), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()